@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+'''DATABASE BENCHMARK - time the operations of NSD_DBLEAF_BRANCH on synthetic branches
+
+Builds a branch of LEAVES synthetic objects, each with WIDTH extra metadata fields, at
+DEPTH levels of sub-branches below a root branch in a temporary directory, and times
+ADD, SEARCH, LOAD, UPDATE, NUMITEMS, WRITEOBJECTFILE, READOBJECTFILE and REMOVE (and
+SEARCH_TREE from the root). Each MEMORY mode is run in its own process so that its peak
+RSS can be reported. Results (operations per second, median and 99th percentile latency,
+peak RSS) are printed and written as JSON, so that runs can be compared across commits:
+
+    python "Database benchmark.py" --leaves 2000 --width 8 --depth 2 --output before.json
+
+The database classes rely on NSD_DBLEAF, NSD_PICKDBLEAF, SAVESTRUCTARRAY, LOADSTRUCTARRAY
+and STRUCTMERGE from the rest of NSD. Files named with --source are executed in the same
+namespace after Database file1.py and before Database file2.py to provide them.'''
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# a leaf with WIDTH extra metadata fields, which are saved in its object file as JSON
+benchleafsource = '''
+class nsd_benchleaf(nsd_dbleaf):
+    def __init__(self, name='', command='', fields=None):
+        self._fields_ = json.dumps(fields or {})
+        super().__init__(name, command)
+
+    def metadatastruct(self):
+        md = super().metadatastruct()
+        md.update(json.loads(self._fields_))
+        return md
+
+    def stringdatatosave(self):
+        [data, fieldnames] = super().stringdatatosave()
+        data.append(self._fields_)
+        fieldnames.append('$fields')
+        return data, fieldnames
+'''
+
+
+def loadnamespace(sources):
+    '''LOADNAMESPACE - execute the database files and SOURCES in one namespace and return it'''
+    ns = {'__name__': 'nsd_benchmark'}
+    files = [os.path.join(here, 'Database file1.py')] + list(sources) + [os.path.join(here, 'Database file2.py')]
+    for f in files:
+        with open(f) as fid:
+            exec(compile(fid.read(), f, 'exec'), ns)
+    exec('import json\n' + benchleafsource, ns)
+    return ns
+
+
+def timeit(results, op, calls):
+    '''TIMEIT - call each function in CALLS, and add the timings of OP to RESULTS'''
+    times = []
+    errors = 0
+    error = ''
+    for call in calls:
+        t0 = time.perf_counter()
+        try:
+            call()
+        except Exception as e:
+            errors += 1
+            error = repr(e)
+            continue
+        times.append(time.perf_counter()-t0)
+    results.append(summarize(op, times, errors, error))
+
+
+def summarize(op, times, errors=0, error=''):
+    '''SUMMARIZE - operations per second and latency percentiles (in microseconds) of TIMES'''
+    times = sorted(times)
+    n = len(times)
+    def percentile(p):
+        return times[min(n-1, int(p*n))]*1e6 if n else None
+    result = {'op': op, 'n': n, 'ops_per_sec': n/sum(times) if n and sum(times) else None,
+              'p50_us': percentile(0.50), 'p99_us': percentile(0.99)}
+    if errors:
+        result['errors'] = errors
+        result['error'] = error
+    return result
+
+
+def fieldvalues(width, i):
+    '''FIELDVALUES - the extra metadata of leaf I: alternately integers and strings'''
+    return {'field%d' % k: (i*7+k) % 1000 if k % 2 == 0 else 'value%d' % ((i+k) % 97) for k in range(width)}
+
+
+def runmode(ns, args, memory):
+    '''RUNMODE - build a tree in a temporary directory and time the operations for one MEMORY mode'''
+    branchclass = ns['nsd_dbleaf_branch']
+    leafclass = ns['nsd_benchleaf']
+    options = {'columnar': args.columnar, 'journal': args.journal}
+    if args.binary:
+        options['binary'] = 1
+    if memory and args.compact:
+        options['compact'] = 1
+    if args.packed:
+        options['packed'] = 1
+    classnames = ['nsd_benchleaf', 'nsd_dbleaf_branch']
+    rng = random.Random(args.seed)
+    results = []
+    tmp = tempfile.mkdtemp(prefix='nsd_benchmark_', dir=args.dir)
+    try:
+        try:
+            root = branchclass(tmp, 'root', classnames, 0, 0 if args.depth else memory, **options)
+            branch = root
+            for level in range(args.depth):
+                # the constructor adds the child to BRANCH; keep the object we built, with its options
+                branch = branchclass(branch, 'level%d' % level, classnames, 0, memory if level == args.depth-1 else 0, **options)
+        except Exception as e:
+            results.append(summarize('setup', [], 1, repr(e)))
+            return {'memory': memory, 'results': results,
+                    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        n = args.leaves
+        with ns['nsd_ids'].batch(n): # one reservation of identifiers for all the leaves
+            leaves = [leafclass('leaf%d' % i, '', fieldvalues(args.width, i)) for i in range(n)]
+        timeit(results, 'add', [lambda leaf=leaf: branch.add(leaf) for leaf in leaves])
+        q = min(args.queries, n)
+        picks = [rng.randrange(n) for i in range(q)]
+        timeit(results, 'search _name_', [lambda i=i: branch.search('_name_', 'leaf%d' % i) for i in picks])
+        if args.width:
+            timeit(results, 'search field0', [lambda i=i: branch.search('field0', (i*7) % 1000) for i in picks])
+            timeit(results, 'search regexp', [lambda: branch.search('field1', 'value1.*')])
+        timeit(results, 'load', [lambda i=i: branch.load('_name_', 'leaf%d' % i) for i in picks])
+        timeit(results, 'numitems', [branch.numitems for i in picks])
+        timeit(results, 'update', [lambda i=i: branch.update(leaves[i]) for i in picks])
+        timeit(results, 'search_tree', [lambda: root.search_tree('_name_', 'leaf0')])
+        writes = max(1, q//10)
+        timeit(results, 'writeobjectfile', [lambda: branch.writeobjectfile(branch._path_) for i in range(writes)])
+        filename = branch._path_+'/'+branch._objectfilename_
+        timeit(results, 'readobjectfile', [lambda: branchclass(filename, 'OpenFile') for i in range(writes)])
+        timeit(results, 'remove', [lambda i=i: branch.remove(leaves[i]._objectfilename_) for i in sorted(set(picks))])
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return {'memory': memory, 'results': results,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def gitcommit():
+    '''GITCOMMIT - the commit of the working tree, or None'''
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(modes):
+    '''REPORT - print a table of the results of each MEMORY mode'''
+    for mode in modes:
+        print('memory=%d  peak RSS %.1f MB' % (mode['memory'], mode['peak_rss_kb']/1024))
+        for r in mode['results']:
+            if not r['n']:
+                print('  %-16s failed: %s' % (r['op'], r.get('error', '')))
+                continue
+            print('  %-16s %8d ops  %12.1f ops/s  p50 %10.1f us  p99 %10.1f us%s' % (r['op'], r['n'],
+                  r['ops_per_sec'] or 0, r['p50_us'], r['p99_us'], '  (%d errors)' % r['errors'] if r.get('errors') else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark NSD_DBLEAF_BRANCH operations.')
+    parser.add_argument('--leaves', type=int, default=1000, help='number of leaves in the branch')
+    parser.add_argument('--width', type=int, default=4, help='extra metadata fields per leaf')
+    parser.add_argument('--depth', type=int, default=1, help='levels of sub-branches above the branch')
+    parser.add_argument('--queries', type=int, default=200, help='calls per search/load/update/remove')
+    parser.add_argument('--memory', type=int, nargs='+', default=[0, 1], choices=[0, 1], help='MEMORY modes to run')
+    parser.add_argument('--columnar', type=int, default=0, help='COLUMNAR option of the branches')
+    parser.add_argument('--binary', type=int, default=0, help='use the binary metadata format')
+    parser.add_argument('--journal', type=int, default=0, help='JOURNAL option of the branches (bytes)')
+    parser.add_argument('--compact', type=int, default=0, help='COMPACT option of MEMORY=1 branches')
+    parser.add_argument('--packed', type=int, default=0, help='PACKED option of the branches')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dir', default=None, help='directory for the temporary files')
+    parser.add_argument('--source', action='append', default=[], help='file that provides the rest of NSD (repeatable)')
+    parser.add_argument('--output', default=None, help='JSON file to write the results to')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        # run one MEMORY mode and hand the results to the parent on stdout
+        ns = loadnamespace(args.source)
+        json.dump(runmode(ns, args, args.memory[0]), sys.stdout)
+        return
+    modes = []
+    for memory in args.memory:
+        childargv = stripoption(argv if argv is not None else sys.argv[1:], '--memory')
+        childargv = [sys.executable, os.path.abspath(__file__)] + childargv + ['--memory', str(memory), '--child']
+        out = subprocess.run(childargv, capture_output=True, text=True)
+        if out.returncode:
+            sys.stderr.write(out.stderr)
+            raise SystemExit('benchmark of memory=%d failed' % memory)
+        modes.append(json.loads(out.stdout))
+    report(modes)
+    if args.output:
+        config = {k: v for k, v in vars(args).items() if k not in ('output', 'child')}
+        with open(args.output, 'w') as fid:
+            json.dump({'commit': gitcommit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version,
+                       'config': config, 'modes': modes}, fid, indent=1)
+
+
+def stripoption(argv, option):
+    '''STRIPOPTION - remove OPTION and the values that follow it from the argument list ARGV'''
+    out = []
+    skipping = False
+    for a in argv:
+        if a == option or a.startswith(option+'='):
+            skipping = a == option
+            continue
+        if skipping and not a.startswith('-'):
+            continue
+        skipping = False
+        out.append(a)
+    return out
+
+
+if __name__ == '__main__':
+    main()
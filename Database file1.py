@@ -1,17 +1,125 @@
 # -*- coding: utf-8 -*-
 import time
-import numpy as np
 import os
 import sys
+import fcntl
+import socket
+import threading
+import contextlib
+import collections
+import ast
+import bisect
+import functools
+
+nsd_locktimeout = 30 # seconds that LOCK waits for a lock held by someone else, by default
+
+
+class nsd_iostats:
+    '''NSD_IOSTATS - counts, times and bytes of database operations, to see where the time goes
+
+    Nothing is recorded unless ENABLED is True (see NSD_COLLECTSTATS), so that when it is off
+    an instrumented operation costs one attribute test. For each operation name, the number
+    of calls, the total seconds (including any operations nested in it) and the bytes read
+    and written are kept. Waits for locks are also counted in a histogram of their durations.'''
+
+    lockwaitbounds = (1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1, 10) # upper bounds (seconds) of the lock wait bins; one more bin holds longer waits
+
+    def __init__(self):
+        self.enabled = False
+        self.mutex = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''RESET - forget everything recorded so far'''
+        with self.mutex:
+            self.ops = {} # name -> [calls, seconds, bytes read, bytes written]
+            self.lockwaits = [0]*(len(self.lockwaitbounds)+1)
+            self.locktimeouts = 0
+
+    def record(self, name, seconds=0.0, bytesread=0, byteswritten=0, calls=1):
+        '''RECORD - add CALLS calls that took SECONDS and moved the given bytes to the operation NAME'''
+        with self.mutex:
+            op = self.ops.get(name)
+            if op is None:
+                op = self.ops[name] = [0, 0.0, 0, 0]
+            op[0] += calls
+            op[1] += seconds
+            op[2] += bytesread
+            op[3] += byteswritten
+
+    def recordlockwait(self, seconds, obtained=1):
+        '''RECORDLOCKWAIT - count a wait of SECONDS for a lock, which timed out if OBTAINED is 0'''
+        with self.mutex:
+            self.lockwaits[bisect.bisect_left(self.lockwaitbounds, seconds)] += 1
+            if not obtained:
+                self.locktimeouts += 1
+
+    def call(self, name, f, *args, **kwargs):
+        '''CALL - return F(*ARGS, **KWARGS), timing the call as the operation NAME if enabled'''
+        if not self.enabled:
+            return f(*args, **kwargs)
+        t0 = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.record(name, time.perf_counter()-t0)
+
+    def stats(self):
+        '''STATS - return what has been recorded, as a dictionary
+        {'ops': {NAME: {'calls', 'seconds', 'bytes_read', 'bytes_written'}},
+         'lockwait': {'bounds', 'counts', 'timeouts'}}'''
+        with self.mutex:
+            ops = {name: {'calls': op[0], 'seconds': op[1], 'bytes_read': op[2], 'bytes_written': op[3]}
+                   for name, op in self.ops.items()}
+            return {'ops': ops, 'lockwait': {'bounds': list(self.lockwaitbounds),
+                    'counts': list(self.lockwaits), 'timeouts': self.locktimeouts}}
+
+
+nsd_stats = nsd_iostats() # the statistics of all database operations in this process
+
+
+def nsd_instrumented(name):
+    '''NSD_INSTRUMENTED - decorator that times a function as the operation NAME of NSD_STATS'''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not nsd_stats.enabled:
+                return f(*args, **kwargs)
+            return nsd_stats.call(name, f, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def nsd_collectstats(reset=1):
+    '''NSD_COLLECTSTATS - collect NSD_STATS for the duration of a WITH block
+
+    with NSD_COLLECTSTATS() as STATS:
+        ...
+    print(STATS.STATS())
+
+    Forgets earlier statistics if RESET is 1 (the default), and restores the previous
+    ENABLED setting when the block is left.'''
+    enabled = nsd_stats.enabled
+    if reset:
+        nsd_stats.reset()
+    nsd_stats.enabled = True
+    try:
+        yield nsd_stats
+    finally:
+        nsd_stats.enabled = enabled
 
 
 class nsd_base:
     '''# NSD_BASE - A node that fits into an NSD_BASE_BRANCH'''
 
+    # functions that convert the saved strings of properties that are not strings (see FIELDTABLE)
+    fieldtypes = {}
+
     def __init__(self, filename='', command=''):
         ''' __INIT__ - Creates a named NSD_BASE object
         Creates an NSD_BASE object. Each NSD_BASE object has a unique
-        identifier that is stored in the property 'objectfilename'. The class
+        identifier that is stored in the property 'objectfilename' (see NSD_IDGENERATOR). The class
         includes methods for writing and reading object files in a platform- and
         language-independent manner.
         
@@ -23,32 +131,37 @@ class nsd_base:
         All NSD_BASE descendents must offer this 2 element constructor.
          
         See also: NSD_DBLEAF, NSD_BASE'''
-        self._objectfilename_ = 'object_%s_%s'%(hex(int(time.time())), hex(np.random.randint(100000)))
-        self.__lockfid__ = []
+        self._objectfilename_ = nsd_ids.newid()
+        self.__lockfid__ = {} # lock file name -> NSD_LOCKFILE, for the locks this object takes
         if command.lower()=='openfile':
             self.readobjectfile(filename)
     
+    @nsd_instrumented('readobjectfile')
     def readobjectfile(self, filename):
         '''READOBJECTFILE - read the object from a file
         
-        Reads the NSD_BASE_OBJ from the file FILENAME.
+        Reads the NSD_BASE_OBJ from the file FILENAME, which may also be an open file
+        (or other object with a READ method) positioned at the start of the object.
         
         The file format consists of several strings that are read in sequence.
         The first line is always the name of the object class.'''
-        with open(filename, 'r') as fid: # files will consistently use big-endian
-            classname = fid.readline()[:-1]
-            if classname==type(self).__name__:
-                # we have the right type of object
-                [dummy,fn] = self.stringdatatosave()
-                values = []
-                i=1
-                values.append('')
-                while i<len(fn):
-                    values.append(fid.readline()[:-1])
-                    i=i+1
-                self.setproperties(fn, values)
-            else:
-                raise Exception(['Not a valid NSD_BASE file:' + filename ])
+        if hasattr(filename, 'read'):
+            text = filename.read()
+            filename = getattr(filename, 'name', '<file>')
+        else:
+            with open(filename, 'r') as fid:
+                text = fid.read()
+        if nsd_stats.enabled:
+            nsd_stats.record('readobjectfile', bytesread=len(text), calls=0)
+        lines = text.split('\n')
+        if lines[0]==type(self).__name__:
+            # we have the right type of object
+            [dummy,fn] = self.stringdatatosave()
+            values = ['']+lines[1:len(fn)]
+            values += ['']*(len(fn)-len(values))
+            self.setproperties(fn, values)
+        else:
+            raise Exception(['Not a valid NSD_BASE file:' + str(filename) ])
         return self
     
     def deleteobjectfile(self, dirname):
@@ -69,18 +182,35 @@ class nsd_base:
         VALUES, sets the fields in NSD_BASE_OBJ and returns the result in OBJ.
        
         If any entries in PROPERTIES are not properties of NSD_BASE_OBJ, then that property is skipped.
-        The properties that are actually set are returned in PROPERTIESSET.'''
+        The properties that are actually set are returned in PROPERTIESSET.
+        Values are converted to the type of the property given by FIELDTABLE.'''
         fn=vars(self)
+        table=self.fieldtable()
         properties_set = []
         for i in range(len(properties)):
             if properties[i].startswith('$'):
                 properties[i]='_'+properties[i][1:]+'_'
         for i in range(len(properties)):
             if properties[i] in fn:
-               exec('self.'+properties[i]+'="'+values[i]+'"')
+               setattr(self, properties[i], table.get(properties[i], str)(values[i]))
                properties_set.append(properties[i])
         return properties_set
+
+    @classmethod
+    def fieldtable(cls):
+        '''FIELDTABLE - the types of the properties of objects of this class
+        Returns a dictionary mapping the name of each property that is not a string to the
+        function that converts its saved string (such as INT or NSD_DECODELIST). It merges
+        the FIELDTYPES of the class and its ancestors and is built once per class.'''
+        table = nsd_fieldtables.get(cls)
+        if table is None:
+            table = {}
+            for c in reversed(cls.__mro__):
+                table.update(vars(c).get('fieldtypes', {}))
+            nsd_fieldtables[cls] = table
+        return table
            
+    @nsd_instrumented('writeobjectfile')
     def writeobjectfile(self, dirname='', locked=0):
         '''WRITEOBJECTFILE - write the object file to a file	
         the NSD_BASE_OBJ to a file in a manner that can be
@@ -88,18 +218,17 @@ class nsd_base:
         Writes to the path DIRNAME/NSD_BASE_OBJ.OBJECTFILENAME
         If LOCKED is 1, then the calling function has verified a correct
         the file and WRITEOBJECTFILE shouldn't lock/unlock it.
+        Otherwise the lock is taken here, and an exception is raised if it cannot be obtained.
         See also: NSD_BASE/NSD_BASE'''
-        thisfunctionlocked = 0
-        if not locked: # we need to lock it
-            self.lock(dirname)
-            thisfunctionlocked = 1
         filename = dirname+'/'+self._objectfilename_
-        with open(filename, 'w') as fid:
-            data,fieldnames = self.stringdatatosave()
-            for i in range(len(data)):
-                fid.write(data[i]+'\n')
-        if thisfunctionlocked:
-            self.unlock(dirname) 
+        with contextlib.nullcontext() if locked else self.locked(dirname):
+            # readers that do not lock see either the old file or the new one, never a partial one
+            with nsd_atomicfile(filename, 'w') as fid:
+                data,fieldnames = self.stringdatatosave()
+                for i in range(len(data)):
+                    fid.write(data[i]+'\n')
+                if nsd_stats.enabled:
+                    nsd_stats.record('writeobjectfile', byteswritten=fid.tell(), calls=0)
             
     def stringdatatosave(self):
         '''STRINGDATATOSAVE - Returns a set of strings to write to file to save object information
@@ -123,26 +252,30 @@ class nsd_base:
         lockfname = filename+'-lock'
         return lockfname
     
-    def lock(self, dirname):
+    def lock(self, dirname, exclusive=1, timeout=None):
         '''LOCK - lock the metadata file and object files so other processes cannot change them
         
         Attempts to obtain the lock on the object file. If it is successful,
         B is 1. Otherwise, B is 0. DIRNAME is the directory where the file(s)
         is(are) stored (full path).
+
+        If EXCLUSIVE is 1 (the default), the lock is exclusive, as needed by writers; if it
+        is 0, the lock is shared with other readers. If the lock is held by someone else,
+        LOCK waits up to TIMEOUT seconds for it (NSD_LOCKTIMEOUT by default; 0 does not wait).
+        The lock is an advisory fcntl lock, so it is released by the operating system if
+        the process that holds it dies. Locking again from the same thread nests; the lock
+        is released by the matching number of calls to UNLOCK.
         
         Note: Only a function that calls LOCK should call UNLOCK to maintain integrety of object data.
         
-        See also: NSD_BASE/LOCK NSD_BASE/UNLOCK NSD_BASE/LOCKFILENAME'''
-        b = 0
-        lockfid = checkout_lock_file(self.lockfilename(dirname))
-        if lockfid!=-1:
-            self.__lockfid__ = lockfid
-            b=1
-        return b
+        See also: NSD_BASE/LOCK NSD_BASE/UNLOCK NSD_BASE/LOCKFILENAME NSD_BASE/LOCKED'''
+        lockfname = self.lockfilename(dirname)
+        lockfid = self.__lockfid__.setdefault(lockfname, nsd_lockfile(lockfname))
+        return lockfid.acquire(exclusive, timeout)
             
     def unlock(self, dirname):
         '''UNLOCK - unlock the metadata file and object files so other processes can change them
-        Removes the lock file from the NSD_BASE NSD_BASE_OBJ.
+        Releases the lock of the NSD_BASE NSD_BASE_OBJ.
 
         DIRNAME is the directory where the file(s) is (are) stored (full path).
 
@@ -151,14 +284,363 @@ class nsd_base:
 
         See also: NSD_BASE/LOCK NSD_BASE/UNLOCK NSD_BASE/LOCKFILENAME'''
         b=1
-        if self.__lockfid__:
+        lockfid = self.__lockfid__.get(self.lockfilename(dirname))
+        if lockfid:
+            b = lockfid.release()
+        return b
+
+    @contextlib.contextmanager
+    def locked(self, *args, **kwargs):
+        '''LOCKED - hold the lock for the duration of a WITH block
+
+        with NSD_BASE_OBJ.LOCKED(DIRNAME, [EXCLUSIVE], [TIMEOUT]):
+            ...
+
+        Calls LOCK with the same arguments, raises an exception if the lock cannot be
+        obtained, and calls UNLOCK when the block is left, even by an exception.
+
+        See also: NSD_BASE/LOCK NSD_BASE/UNLOCK'''
+        if not self.lock(*args, **kwargs):
+            raise Exception('Could not obtain the lock of object ' + self._objectfilename_ + '. ' + self.lockholder(*args[:1]))
+        try:
+            yield self
+        finally:
+            self.unlock(*args[:1])
+
+    def lockholder(self, dirname=''):
+        '''LOCKHOLDER - describe who holds the lock of the object in DIRNAME, for error messages'''
+        if not dirname:
+            return ''
+        return nsd_lockfile(self.lockfilename(dirname)).describe()
+
+
+nsd_fieldtables = {} # class -> its NSD_BASE/FIELDTABLE
+
+
+class nsd_idgenerator:
+    '''NSD_IDGENERATOR - makes unique, sortable object identifiers
+
+    Identifiers have the form PREFIX<time>_<node>_<counter>: the time in milliseconds
+    (12 hex digits), a node number that is different in every process (6 hex digits of the
+    process id and 6 random ones, chosen again in a child after a fork), and a counter
+    (6 hex digits) for identifiers made in the same millisecond. A thread never gets an
+    identifier lower than its last one, even if the clock steps back, and all of them sort
+    by time.
+
+    NEWID hands out identifiers from a block made by RESERVE, so that the clock is read and
+    the strings are built once per block; see NEWID and BATCH.'''
+
+    counters = ['%06x' % c for c in range(4096)] # the common counter strings, made once
+    maxblock = 256 # the largest block NEWID makes
+
+    def __init__(self, prefix='object_'):
+        self.prefix = prefix
+        self.reseed()
+
+    def reseed(self):
+        '''RESEED - choose a new node number and start over (called in a child after a fork)'''
+        self.mutex = threading.Lock()
+        self.node = '%06x%s' % (os.getpid() & 0xffffff, os.urandom(3).hex())
+        self.settime(0)
+        self.counter = -1 # the last counter used at time MS
+        self.pool = collections.deque() # identifiers made but not yet handed out
+        self.fresh = 0 # the POOL may be used until this time (time.monotonic_ns)
+        self.block = 1
+
+    def settime(self, ms):
+        '''SETTIME - set the time of the next identifiers and the start they share'''
+        self.ms = ms
+        self.head = '%s%012x_%s_' % (self.prefix, ms, self.node)
+
+    def newid(self):
+        '''NEWID - return a new identifier
+
+        The identifier comes from the block of the last call if that block was made less
+        than a millisecond ago (so its time is still right); otherwise a new block is made.
+        The block doubles while it runs out within a millisecond and halves when it goes
+        stale, so a loop that makes many objects pays for the clock and the string
+        formatting once per block.'''
+        if time.monotonic_ns() < self.fresh:
+            try:
+                return self.pool.popleft()
+            except IndexError:
+                pass
+        with self.mutex:
+            now = time.monotonic_ns()
+            if now < self.fresh:
+                try: # another thread may have made a block while we waited
+                    return self.pool.popleft()
+                except IndexError:
+                    pass
+                self.block = min(self.block*2, self.maxblock)
+            else:
+                self.block = max(self.block//2, 1)
+            ids = self.makeids(self.block)
+            self.pool = collections.deque(ids[1:])
+            self.fresh = now + 1000000
+            return ids[0]
+
+    def reserve(self, n):
+        '''RESERVE - return a list of N new identifiers, for objects that are made in a batch
+        The identifiers are consecutive and are made under one acquisition of the lock.'''
+        with self.mutex:
+            return self.makeids(n)
+
+    @contextlib.contextmanager
+    def batch(self, n):
+        '''BATCH - reserve N identifiers for the objects made inside a WITH block
+
+        with nsd_ids.batch(len(rows)):
+            leaves = [nsd_dbleaf(...) for r in rows]
+
+        NEWID takes the reserved identifiers first, however long the block takes; they carry
+        the time the batch began. Identifiers left over at the end are not used.'''
+        with self.mutex:
+            self.pool = collections.deque(self.makeids(n))
+            self.fresh = float('inf')
+        try:
+            yield self
+        finally:
+            with self.mutex:
+                self.pool = collections.deque()
+                self.fresh = 0
+
+    def makeids(self, n):
+        '''MAKEIDS - make N consecutive identifiers (the caller holds MUTEX)'''
+        ids = []
+        ms = time.time_ns()//1000000
+        if ms > self.ms:
+            self.settime(ms)
+            self.counter = -1
+        while len(ids) < n:
+            first = self.counter+1
+            last = min(first+n-len(ids), 0x1000000)
+            if last <= len(self.counters):
+                ids.extend(map(self.head.__add__, self.counters[first:last]))
+            else:
+                head = self.head
+                ids.extend([head + '%06x' % c for c in range(first, last)])
+            self.counter = last-1
+            if last == 0x1000000:
+                self.settime(self.ms+1)
+                self.counter = -1
+        return ids
+
+
+nsd_ids = nsd_idgenerator() # makes the OBJECTFILENAME of every new NSD_BASE object
+os.register_at_fork(after_in_child=nsd_ids.reseed)
+
+
+def nsd_decodeint(value):
+    '''NSD_DECODEINT - convert a saved 0/1 or integer property to an int ('' is 0)'''
+    if isinstance(value, str):
+        value = value.strip()
+        if value in ('', 'False', 'True'):
+            return int(value=='True')
+    return int(value)
+
+
+def nsd_decodelist(value):
+    '''NSD_DECODELIST - convert a saved list property, such as ['a', 'b'], to a list
+    The string is parsed as a Python literal, never evaluated. A string that is not a
+    list literal is taken to be a single element; '' is the empty list.'''
+    if not isinstance(value, str):
+        return list(value)
+    if not value:
+        return []
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return [value]
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+@contextlib.contextmanager
+def nsd_atomicfile(filename, mode='w', sync=1):
+    '''NSD_ATOMICFILE - write a file so that readers see either its old or its new contents
+
+    with NSD_ATOMICFILE(FILENAME, MODE) as FID:
+        FID.write(...)
+
+    The data are written to a temporary file in the same directory, which is flushed to
+    disk (unless SYNC is 0) and then renamed over FILENAME when the block ends. If the block
+    raises an exception, the temporary file is removed and FILENAME is left untouched.'''
+    tmpname = nsd_tempfilename(filename)
+    try:
+        with open(tmpname, mode) as fid:
+            yield fid
+            fid.flush()
+            if sync:
+                os.fsync(fid.fileno())
+        nsd_replacefile(tmpname, filename, 0, sync)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def nsd_tempfilename(filename):
+    '''NSD_TEMPFILENAME - a temporary file name next to FILENAME, unique to this process and thread'''
+    return '%s.tmp%d_%d' % (filename, os.getpid(), threading.get_ident())
+
+
+def nsd_replacefile(tmpname, filename, synctmp=1, syncdir=1):
+    '''NSD_REPLACEFILE - atomically rename the finished file TMPNAME to FILENAME
+    If SYNCTMP is 1, TMPNAME is flushed to disk first. If SYNCDIR is 1, the directory
+    is flushed afterwards, so that the rename itself survives a crash.'''
+    if synctmp:
+        fd = os.open(tmpname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    os.replace(tmpname, filename)
+    if syncdir:
+        try:
+            fd = os.open(os.path.dirname(filename) or '.', os.O_RDONLY)
             try:
-                self.__lockfid__.close()
-                os.remove(self.lockfilename(dirname))
-                self.__lockfid__ = []
-            except:
-                b=0
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+
+class nsd_lockfile:
+    '''NSD_LOCKFILE - A lock shared between threads and processes through an fcntl lock on a file
+
+    The lock file is created when the lock is taken and removed when the last holder
+    releases it. An exclusive holder writes its process id and host name into the file,
+    for error messages (see DESCRIBE); a shared holder clears them, as there is then no
+    exclusive holder. The lock is never broken by removing the file of a lock that is
+    held: the system releases the fcntl lock of a process that exits, so a lock file that
+    a crashed process left behind is simply locked and reused by the next holder.
+
+    Within the process, the lock belongs to one thread at a time and is reentrant for that
+    thread. If FILENAME is None, the lock only works within the process.'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = None # file descriptor that holds the fcntl lock
+        self.count = 0 # number of nested acquisitions by the owner
+        self.owner = None # thread that holds the lock
+        self.condition = threading.Condition()
+
+    def __bool__(self):
+        return self.count>0
+
+    def ismine(self):
+        '''ISMINE - does the calling thread hold the lock?'''
+        with self.condition:
+            return self.owner == threading.get_ident() and self.count>0
+
+    def acquire(self, exclusive=1, timeout=None):
+        '''ACQUIRE - obtain the lock
+        B = ACQUIRE(NSD_LOCKFILE_OBJ, [EXCLUSIVE], [TIMEOUT])
+        Waits up to TIMEOUT seconds (NSD_LOCKTIMEOUT if None) for the lock. Returns 1 if the
+        lock was obtained and 0 otherwise.'''
+        if not nsd_stats.enabled:
+            return self.acquirelock(exclusive, timeout)
+        t0 = time.perf_counter()
+        b = self.acquirelock(exclusive, timeout)
+        seconds = time.perf_counter()-t0
+        nsd_stats.record('lock', seconds)
+        nsd_stats.recordlockwait(seconds, b)
         return b
-            
-            
-  
+
+    def acquirelock(self, exclusive, timeout):
+        '''ACQUIRELOCK - obtain the lock (see ACQUIRE)'''
+        if timeout is None:
+            timeout = nsd_locktimeout
+        deadline = time.monotonic() + timeout
+        me = threading.get_ident()
+        with self.condition:
+            if self.owner == me:
+                self.count += 1
+                return 1
+            if not self.condition.wait_for(lambda: self.owner is None, timeout):
+                return 0
+            self.owner = me
+        try:
+            b = self.filename is None or self.lockfile(exclusive, deadline)
+        except BaseException:
+            b = 0
+            raise
+        finally:
+            with self.condition:
+                if b:
+                    self.count = 1
+                else:
+                    self.owner = None
+                    self.condition.notify_all()
+        return int(b)
+
+    def lockfile(self, exclusive, deadline):
+        '''LOCKFILE - take the fcntl lock on the lock file, waiting until DEADLINE'''
+        delay = 0.001
+        while True:
+            fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return 0
+                time.sleep(min(delay, remaining))
+                delay = min(2 * delay, 0.05)
+                continue
+            # the previous holder may have removed the file between our open and our lock
+            try:
+                current = os.stat(self.filename).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                current = False
+            if not current:
+                os.close(fd)
+                continue
+            os.ftruncate(fd, 0) # any holder recorded in the file is gone
+            if exclusive:
+                os.pwrite(fd, ('%d %s\n' % (os.getpid(), socket.gethostname())).encode(), 0)
+            self.fd = fd
+            return 1
+
+    @nsd_instrumented('unlock')
+    def release(self):
+        '''RELEASE - release the lock
+        Returns 1 if the lock was released (or is still held by an outer acquisition), and 0
+        if the calling thread does not hold it.'''
+        with self.condition:
+            if self.owner != threading.get_ident() or not self.count:
+                return 0
+            self.count -= 1
+            if self.count:
+                return 1
+            if self.fd is not None:
+                try:
+                    # remove the lock file if nobody else is waiting on it or sharing it, and
+                    # if it is still our file and not one made since by a newer holder
+                    fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    if os.stat(self.filename).st_ino == os.fstat(self.fd).st_ino:
+                        os.remove(self.filename)
+                except OSError:
+                    pass
+                os.close(self.fd)
+                self.fd = None
+            self.owner = None
+            self.condition.notify_all()
+        return 1
+
+    def holder(self):
+        '''HOLDER - return [PID, HOSTNAME] of the exclusive holder recorded in the lock file, or None'''
+        try:
+            with open(self.filename, 'r') as fid:
+                pid, hostname = fid.readline().split()
+            return [int(pid), hostname]
+        except (OSError, ValueError):
+            return None
+
+    def describe(self):
+        '''DESCRIBE - a sentence naming the holder of the lock, for error messages'''
+        holder = self.holder()
+        if holder is None:
+            return 'The lock ' + str(self.filename) + ' is in use.'
+        return 'The lock ' + self.filename + ' is held by process ' + str(holder[0]) + ' on ' + holder[1] + '.'
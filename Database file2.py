@@ -1,14 +1,32 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
+import copy
 import shutil
 import numpy as np
 import time
 import re
+import functools
+import json
+import collections
+import collections.abc
+import mmap
+import struct
+import array
+import io
+import zlib
+import contextlib
+import ast
+import pickle
+import threading
+import concurrent.futures
+import asyncio
 
 class nsd_dbleaf_branch(nsd_dbleaf):
     ''' NSD_DBLEAF_BRANCH - A class that manages branches of NSD_DBLEAF objects with searchable metadata'''
-    def __init__(self, path='', name='', classnames=[], isflat=0, memory=0):
+
+    fieldtypes = {'_memory_': nsd_decodeint, '_isflat_': nsd_decodeint, '_classnames_': nsd_decodelist, '_layout_': nsd_decodeint, '_packed_': nsd_decodeint}
+    def __init__(self, path='', name='', classnames=[], isflat=0, memory=0, journal=0, columnar=0, binary=None, compact=0, layout=0, packed=0):
         ''' NSD_DBLEAF_BRANCH - Create a database branch of objects with searchable metadata
         
         DBBRANCH = NSD_DBLEAF_BRANCH(PATH, NAME, CLASSNAMES, [ISFLAT], [MEMORY])
@@ -21,6 +39,43 @@ class nsd_dbleaf_branch(nsd_dbleaf):
         this NSD_DBLEAF_BRANCH object should only store its objects in memory (1) or write objects
         to disk as they are added (1).
 
+        The optional keyword argument JOURNAL selects how changes to the metadata are saved.
+        If it is 0 (the default), ADD, UPDATE and REMOVE rewrite the whole metadata file. If it
+        is a number of bytes, each change is instead appended to a journal next to the
+        metadata file, and the journal is compacted into the metadata file once it grows
+        beyond JOURNAL bytes (see NSD_DBLEAF_BRANCH/COMPACT).
+        JOURNAL, like COLUMNAR, COMPACT, LAYOUT and PACKED below, is saved in the object file of
+        the branch, so a branch that is read back (with 'OpenFile' or from its parent) keeps it.
+
+        If the optional keyword argument COLUMNAR is 1, the metadata is held in memory as an
+        NSD_METADATACOLUMNS object (one NumPy array per field) rather than a list of
+        dictionaries, and SEARCH evaluates its terms on whole columns at once.
+
+        The optional keyword argument BINARY selects the format of the metadata file: 1 for
+        the memory-mapped binary format (see NSD_READBINARYMETADATA), 0 for the text format
+        of saveStructArray. If it is None (the default), an existing metadata file keeps its
+        format and new files are text. Binary metadata is always handled as columnar.
+        See also: NSD_DBLEAF_BRANCH/MIGRATEMETADATA
+
+        If the optional keyword argument COMPACT is 1 and MEMORY is 1, the objects of the
+        branch are kept in memory as the text of their object files rather than as Python
+        objects, and LOAD returns NSD_LEAFPROXY objects that read them back when they are
+        used (see NSD_LEAFSTORE). This takes far less memory for many small objects.
+
+        The optional keyword argument LAYOUT selects how the object files are arranged in the
+        subdirectory of the branch: 0 (the default) puts them all in the subdirectory, 1 spreads
+        them over 256 subdirectories by a hash of their object file name, so that opening and
+        removing a file stays fast in branches with very many objects. The layout is saved in
+        the object file of the branch. See also: NSD_DBLEAF_BRANCH/MIGRATELAYOUT, LEAFFILENAME
+
+        If the optional keyword argument PACKED is 1, the objects of the branch are not written
+        to object files of their own but appended to a single segment file next to the metadata
+        file (see NSD_LEAFSEGMENT), which is memory-mapped for reading. This saves a file per
+        object, and loading many objects becomes a few large reads. Objects that are replaced
+        or removed leave dead records behind, which COMPACTLEAVES drops. Sub-branches, and
+        objects that manage their own files (see NSD_PACKABLE), still get files of their own.
+        Object files written before the branch was PACKED can still be read.
+
         One may also use the form:
 
         DBBRANCH = NSD_DBLEAF_BRANCH(PARENT_BRANCH, NAME, CLASSNAMES, [ISFLAT], [MEMORY])
@@ -36,16 +91,35 @@ class nsd_dbleaf_branch(nsd_dbleaf):
         DBBRANCHs are containers for NSD_DBLEAF elements.'''
         
         self._path_=''  #String path; where NSD_DBLEAF_BRANCH should store its files
-        self._classnames_=classnames # Cell array of classes that may be stored in the branch
+        self._classnames_=nsd_decodelist(classnames) # Cell array of classes that may be stored in the branch
         self._isflat_=isflat # 0/1 Is this a flat branch (that is, with no subbranches allowed?)
         self._memory_=memory # 0/1 Should this NSD_DBLEAF_BRANCH exist in memory rather than writing files to disk?
+        self._layout_=layout # 0: object files directly in the subdirectory, 1: in hash-prefix subdirectories (see LEAFDIR)
+        self._packed_=packed # 0/1 Are the objects appended to a segment file rather than written to files of their own?
         self.__mdmemory__=[] # metadata in memory (if memory==1)
-        self.__leaf__=[] # cell array of leafs (leaves) if local memory is storage (that is, memory==1)
+        self.__leaf__=nsd_leafstore(compact) # cell array of leafs (leaves) if local memory is storage (that is, memory==1)
+        self.__mdcache__=None # metadata read from disk, valid while the file matches __mdstamp__
+        self.__mdstamp__=None # (mtime, size) of the metadata file when __mdcache__ was read
+        self.__index__={} # hash index of the metadata: field -> {value: [indexes]}
+        self.__indexfields__=['_name_','_objectfilename_'] # fields that SEARCH looks up through __index__
+        self.__journal__=journal # compact the metadata journal beyond this many bytes (0: no journal)
+        self.__columnar__=columnar # 0/1 Keep the metadata as NSD_METADATACOLUMNS rather than a list of dicts?
+        self.__binary__=binary # 0/1 Write the metadata file in the binary format? None: keep the file's format
+        self.__dirnames__=set() # subdirectories that DIRNAME has already made sure exist
+        self.__summary__=None # [stamp, NSD_METADATASUMMARY] of the metadata, see SUMMARY
+        self.__dirty__=set() # objectfilenames of the leaves added or updated in memory since the last FLUSH
+        self.__deleted__=set() # objectfilenames of the leaves removed in memory since the last FLUSH
+        self.__mddirty__=0 # 0/1 Has the metadata in memory changed since the last FLUSH?
+        self.__flusher__=None # [thread, stop event, wake event, dirname, interval, maxdirty] of WRITEBEHIND
+        self.__flusherror__=None # exception raised by the last FLUSH of the WRITEBEHIND thread
+        self.__saveddir__=None # directory that FLUSH saves a branch in memory to incrementally
+        self.__savedobject__=None # [filename, text, (mtime, size)] of the last object file written by WRITEOWNOBJECTFILE
+        self.__compactor__=None # thread of COMPACTLEAVES(BACKGROUND=1)
+        self.__compacterror__=None # exception raised by the last background COMPACTLEAVES
         loadfromfile = 0
         parent = []
         if isinstance(path,nsd_dbleaf):
             parent = path
-            parent._classnames_=[parent._classnames_[2:-2]]
             path=parent.dirname()
             if parent._isflat_:
                 raise Exception('Cannot add subbranch to flat branch. '+ parent._name_+ ' is a flat branch.')
@@ -59,12 +133,16 @@ class nsd_dbleaf_branch(nsd_dbleaf):
             fullfilename = path
             self.readobjectfile(fullfilename)
             return
+        if parent:
+            path=parent.leafdir(self._objectfilename_)
         if os.path.isdir(path) or not path:
             self._path_=path
         else:
             raise Exception('path does not exist.')
         if parent:
-            potential_existing_nsd_dbleaf_branch_obj = parent.load('_name_',self._name_)[0];
+            # an exact match on the name; a string given to LOAD would be a regular expression
+            existing=parent.fieldindex('_name_').get(nsd_indexkey(self._name_),[])
+            potential_existing_nsd_dbleaf_branch_obj = parent.load(existing)[0] if existing else None
             if not potential_existing_nsd_dbleaf_branch_obj:
                 parent.add(self)
             else:
@@ -73,16 +151,233 @@ class nsd_dbleaf_branch(nsd_dbleaf):
                 self=potential_existing_nsd_dbleaf_branch_obj
         
     def metadata(self):
-        '''METADATA - Return the metadata from an NSD_DBLEAF_BRANCH'''
-        if not self._path_:
+        '''METADATA - Return the metadata from an NSD_DBLEAF_BRANCH
+        The metadata file is only parsed again when its modification time or size (or that
+        of the journal) has changed since it was last read; otherwise the cached copy is
+        returned. Changes recorded in the journal are replayed on top of the metadata file.
+        Reading does not take the lock (see NSD_DBLEAF_BRANCH/READSNAPSHOT).
+        If the branch is COLUMNAR, the metadata is returned as an NSD_METADATACOLUMNS object,
+        which is shared with the cache and must not be modified (use its COPY method).'''
+        md=self.cachedmetadata()
+        if isinstance(md,list) and not self.inmemory():
+            md=list(md)
+        return md
+
+    @nsd_instrumented('metadata')
+    def cachedmetadata(self):
+        '''CACHEDMETADATA - Return the metadata of an NSD_DBLEAF_BRANCH without copying it
+        As METADATA, but the list of entries of a branch on disk is the cached one itself, so
+        that a lookup does not cost a copy of the whole list. It must not be modified.'''
+        if self.inmemory():
+            if self.__columnar__ and not isinstance(self.__mdmemory__,nsd_metadatacolumns):
+                self.__mdmemory__=nsd_metadatacolumns(self.__mdmemory__)
             md=self.__mdmemory__
         else:
-            if os.path.isfile(self.metadatafilename()):
-                md=loadStructArray(self.metadatafilename())
-            else:
+            stamp=self.metadatastamp()
+            if stamp is None:
                 md=[]
+                self.__mdcache__=None
+                self.__index__={}
+            else:
+                if self.__mdcache__ is None or stamp!=self.__mdstamp__:
+                    [md,stamp]=self.readsnapshot()
+                    if self.__columnar__ and not isinstance(md,nsd_metadatacolumns):
+                        md=nsd_metadatacolumns(md)
+                    self.__mdcache__=md
+                    self.__mdstamp__=stamp
+                    self.__index__={}
+                md=self.__mdcache__
         return md
-    
+
+    def readsnapshot(self):
+        '''READSNAPSHOT - Read a consistent copy of the metadata files without locking
+        [MD, STAMP] = READSNAPSHOT(NSD_DBLEAF_BRANCH_OBJ)
+        Writers replace the metadata file atomically and bump the generation counter to an
+        odd number before and to an even number after (see GENERATION), so a read that starts
+        and ends at the same even generation saw a metadata file and journal that belong
+        together. After several unlucky attempts the files are read under a shared lock.'''
+        for attempt in range(8):
+            generation=self.generation()
+            if generation%2==0:
+                stamp=self.metadatastamp()
+                md=self.readmetadatafiles(stamp)
+                if self.generation()==generation:
+                    return [md,stamp]
+            time.sleep(0.001*2**attempt)
+        with self.locked(self._path_,0):
+            stamp=self.metadatastamp()
+            return [self.readmetadatafiles(stamp),stamp]
+
+    def reader(self):
+        '''READER - Return a copy of an NSD_DBLEAF_BRANCH for reading in another thread
+        The copy works on the same files and locks, but has its own cache of the metadata and
+        its own field index, so it can be read while this object is being changed by another
+        thread. Like a reader in another process, it sees each change to the metadata file
+        whole (see READSNAPSHOT). Only for a branch on disk; a branch in memory has nothing
+        to read but this object.'''
+        if self.inmemory():
+            raise Exception('The branch '+ self._name_ +' is in memory; it cannot be read from a copy.')
+        obj=copy.copy(self)
+        obj.__mdcache__=None
+        obj.__mdstamp__=None
+        obj.__index__={}
+        obj.__indexfields__=list(self.__indexfields__)
+        obj.__summary__=None
+        obj.__dirnames__=set()
+        return obj
+
+    @nsd_instrumented('readmetadatafiles')
+    def readmetadatafiles(self,stamp):
+        '''READMETADATAFILES - Read the metadata file and replay the journal
+        STAMP is the METADATASTAMP of the files.'''
+        if nsd_stats.enabled and stamp is not None:
+            nsd_stats.record('readmetadatafiles',bytesread=(stamp[1] or 0)+(stamp[3] or 0),calls=0)
+        md=[]
+        if stamp is not None and stamp[0] is not None:
+            try:
+                md=nsd_loadmetadatafile(self.metadatafilename())
+            except FileNotFoundError:
+                pass
+        if stamp is not None:
+            md=nsd_replayjournal(md,self.journalfilename(),stamp[0:2])
+        return md
+
+    def generation(self):
+        '''GENERATION - Return the generation counter of the metadata of an NSD_DBLEAF_BRANCH
+        The counter is incremented before and after every rewrite of the metadata file, so
+        it is odd while a rewrite is in progress. It is 0 for a branch that has never been
+        rewritten.'''
+        try:
+            with open(self.generationfilename(),'r') as fid:
+                return int(fid.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def setgeneration(self,generation,thedirname=''):
+        '''SETGENERATION - Store the generation counter (the caller must hold the lock)'''
+        with nsd_atomicfile(self.generationfilename(thedirname),'w',0) as fid:
+            fid.write(str(generation))
+
+    def inmemory(self):
+        '''INMEMORY - Is the metadata of an NSD_DBLEAF_BRANCH kept in memory?
+        Returns 1 if the metadata lives in __mdmemory__ (the branch has no path or
+        MEMORY is 1), and 0 if it lives in the metadata file.'''
+        return int(not self._path_ or int(self._memory_))
+
+    def metadatastamp(self):
+        '''METADATASTAMP - Identify the version of the metadata file on disk
+        Returns the tuple (MTIME, SIZE, JOURNALMTIME, JOURNALSIZE) of the metadata file
+        and its journal; entries are None for a file that does not exist. Returns None
+        if neither file exists.'''
+        return nsd_metadatastamp(self.metadatafilename())
+
+    @nsd_instrumented('commitmetadata')
+    def commitmetadata(self,record,md):
+        '''COMMITMETADATA - Save a change to the metadata of an NSD_DBLEAF_BRANCH
+        MD is the complete metadata after the change and RECORD describes the change
+        itself: {'add': ROWS}, {'update': {INDEX: ROW}} or {'remove': INDEXES}.
+        If the branch keeps a journal (see JOURNAL in the constructor), RECORD is appended
+        to it; otherwise, or when the journal is due for compaction, MD is written in full.
+        The caller must hold the lock.'''
+        stamp=self.metadatastamp()
+        if not self.__journal__ or stamp is None or stamp[0] is None:
+            self.writeobjectfile([],1,md)
+            return
+        jname=self.journalfilename()
+        line=json.dumps(record,default=nsd_jsonvalue)+'\n'
+        if stamp[2] is not None and nsd_journalbase(jname)!=list(stamp[0:2]):
+            stamp=stamp[0:2]+(None,None) # left over from an interrupted compaction
+        if stamp[2] is None:
+            with nsd_atomicfile(jname,'w') as fid:
+                fid.write(json.dumps({'base':list(stamp[0:2])})+'\n'+line)
+        elif stamp[3]+len(line)>self.__journal__:
+            self.writeobjectfile([],1,md)
+            return
+        else:
+            # readers ignore a last record that has no end of line yet
+            with open(jname,'a') as fid:
+                fid.write(line)
+                fid.flush()
+                os.fsync(fid.fileno())
+        if nsd_stats.enabled:
+            nsd_stats.record('commitmetadata',byteswritten=len(line),calls=0)
+        self.invalidatesubtree()
+        self.cachemetadata(md)
+
+    def migratemetadata(self,binary=1):
+        '''MIGRATEMETADATA - Convert the metadata file of an NSD_DBLEAF_BRANCH to another format
+        Rewrites the metadata file in the binary format (BINARY=1, the default) or in the text
+        format (BINARY=0), folding in any journal, and makes the branch keep writing that format.'''
+        self.__binary__=binary
+        if self.inmemory():
+            return
+        with self.locked():
+            md=self.metadata()
+            if md:
+                self.writeobjectfile([],1,md)
+
+    def compact(self):
+        '''COMPACT - Fold the metadata journal of an NSD_DBLEAF_BRANCH into its metadata file'''
+        with self.locked():
+            if os.path.isfile(self.journalfilename()):
+                self.writeobjectfile([],1,self.metadata())
+
+    def cachemetadata(self,md):
+        '''CACHEMETADATA - Remember metadata that was just written by this object
+        Stores MD as the current metadata so that the next call to METADATA does not have
+        to read the file back. The field index is left alone; callers that change rows
+        are responsible for keeping it up to date (see INDEXROWS, CLEARINDEX).'''
+        if self.inmemory():
+            self.__mdmemory__=md
+        else:
+            self.__mdcache__=md if isinstance(md,nsd_metadatacolumns) else list(md)
+            self.__mdstamp__=self.metadatastamp()
+
+    def addindexfield(self,field):
+        '''ADDINDEXFIELD - Add a metadata field to the set of hash-indexed fields
+        Exact-match searches on FIELD will be answered from an in-memory hash index
+        that is built the first time it is needed.'''
+        if field not in self.__indexfields__:
+            self.__indexfields__.append(field)
+
+    def fieldindex(self,field,md=None):
+        '''FIELDINDEX - Return the hash index of one metadata field
+        IDX = FIELDINDEX(NSD_DBLEAF_BRANCH_OBJ, FIELD, [MD])
+        Returns a dictionary mapping each value of the metadata field FIELD to the list
+        of indexes of the entries that have that value. The index is built lazily and is
+        discarded whenever the metadata file changes on disk. MD is the current metadata;
+        if it is not given, it is obtained with CACHEDMETADATA.'''
+        if md is None:
+            md=self.cachedmetadata()
+        idx=self.__index__.get(field)
+        if idx is None and isinstance(md,nsd_metadatacolumns):
+            idx=md.groupindex(field)
+            self.__index__[field]=idx
+        elif idx is None:
+            idx={}
+            for i in range(len(md)):
+                if field in md[i]:
+                    idx.setdefault(nsd_indexkey(md[i][field]),[]).append(i)
+            self.__index__[field]=idx
+        return idx
+
+    def indexrows(self,rows,old=None):
+        '''INDEXROWS - Update the field index after entries were added or changed
+        ROWS is a dictionary mapping entry index to its (new) metadata. If OLD is given,
+        it maps the same indexes to the metadata the entries had before the change.'''
+        for field,idx in self.__index__.items():
+            for i,row in rows.items():
+                if old is not None and field in old[i]:
+                    bucket=idx.get(nsd_indexkey(old[i][field]),[])
+                    if i in bucket:
+                        bucket.remove(i)
+                if field in row:
+                    idx.setdefault(nsd_indexkey(row[field]),[]).append(i)
+
+    def clearindex(self):
+        '''CLEARINDEX - Discard the field index so that it is rebuilt on next use'''
+        self.__index__={}
+
     def metadatastruct(self):
         ''' METADATASTRUCT - return the metadata fields and values for an NSD_DBLEAF_BRANCH
          Returns the metadata fieldnames and values for NSD_DBLEAF_BRANCH_OBJ.
@@ -96,166 +391,563 @@ class nsd_dbleaf_branch(nsd_dbleaf):
          Adds the item NEWOBJ to the NSD_DBLEAF_BRANCH NSD_DBLEAF_BRANCH_OBJ.  The metadata of the branch
          is updated and the object is written to the subdirectory of NSD_DBLEAF_BRANCH_OBJ.
          NEWOBJ must be a descendent of type NSD_DBLEAF.
-         A branch may not have more than one NSD_DBLEAF with the same 'name' field.'''
-        if not isinstance(newobj,nsd_dbleaf):
-            raise Exception('objects to be added must be descended from NSD_DBLEAF.')
-        
-        if self._isflat_ and isinstance(newobj,nsd_dbleaf_branch):
-            raise Exception('The NSD_DBLEAF_BRANCH ' +self._name_ +' is flat; one cannot add branches to it.')
+         A branch may not have more than one NSD_DBLEAF with the same 'name' field.
+         See also: NSD_DBLEAF_BRANCH/ADD_MANY'''
+        self.add_many([newobj])
+
+    def add_many(self,newobjs):
+        ''' ADD_MANY - Add several items to an NSD_DBLEAF_BRANCH at once
+         Adds the items in the list NEWOBJS to the NSD_DBLEAF_BRANCH NSD_DBLEAF_BRANCH_OBJ, as ADD does
+         for a single item. The whole batch is checked before anything is written: every item
+         must be a descendent of type NSD_DBLEAF of an allowed class, and the names must be unique
+         both within the batch and within the branch. The metadata is then merged once, all the
+         object files are written, and the metadata file is written once, under a single lock.'''
+        if not newobjs:
+            return
+        names=set()
+        for newobj in newobjs:
+            if not isinstance(newobj,nsd_dbleaf):
+                raise Exception('objects to be added must be descended from NSD_DBLEAF.')
             
-        match = 0
-        for i in range(len(self._classnames_)):
-            match=isinstance(newobj,eval(self._classnames_[i]))
-            if match:
-                break
-        if not match:
-            raise Exception('The object of class ' +type(newobj).__name__+ ' does not match any of the allowed classes for the NSD_DBLEAF_BRANCH.')
-        
-        # have to check for unique names in this branch
-        [indexes,md] = self.search('_name_', newobj._name_)
-        if indexes:
-            raise Exception('NSD_DBLEAF with name '+ newobj._name_+ ' already exists in the NSD_DBLEAF_BRANCH ' +self._name_+ '. Names must be unique within a branch.')
-        
-        omd = newobj.metadatastruct()
-        # now have to reconcile possibly different metadata structures
-        fn1=list(dict.keys(md[0]))
-        fn2=list(dict.keys(omd))
-        if not md[0]:
-           md[0]=omd 
-        else:
-            if fn1!=fn2:
-                for j in range(len(md)):
-                    newmd={**md[j],**omd}
-                    for i in newmd:
-                        if i not in md[j]:
-                            md[j].update({i:''})
-                        if i not in omd:
-                            omd.update({i:''})
-            md.append(omd)
+            if self._isflat_ and isinstance(newobj,nsd_dbleaf_branch):
+                raise Exception('The NSD_DBLEAF_BRANCH ' +self._name_ +' is flat; one cannot add branches to it.')
                 
-        # now deal with saving metadata and the object
-        if int(self._memory_):
-            self.__mdmemory__=md
-            self.__leaf__.append(newobj)
-        else:
-            #write the object to our unique subdirectory
-            newobj.writeobjectfile(self.dirname())
-            #now write md back to disk
-            self.writeobjectfile([],0,md)
+            match = 0
+            for classname in self._classnames_:
+                # the names come from the object file, so they are looked up, never evaluated
+                cls=globals().get(classname)
+                if not isinstance(cls,type):
+                    raise Exception('Unknown class '+classname+' in the allowed classes of the NSD_DBLEAF_BRANCH '+self._name_+'.')
+                match=isinstance(newobj,cls)
+                if match:
+                    break
+            if not match:
+                raise Exception('The object of class ' +type(newobj).__name__+ ' does not match any of the allowed classes for the NSD_DBLEAF_BRANCH.')
+            if newobj._name_ in names:
+                raise Exception('NSD_DBLEAF with name '+ newobj._name_+ ' appears more than once in the objects added to the NSD_DBLEAF_BRANCH ' +self._name_+ '. Names must be unique within a branch.')
+            names.add(newobj._name_)
+        
+        with self.locked():
+            # have to check for unique names in this branch
+            md=self.cachedmetadata()
+            if md:
+                nameindex=self.fieldindex('_name_',md)
+                for newobj in newobjs:
+                    if nsd_indexkey(newobj._name_) in nameindex:
+                        raise Exception('NSD_DBLEAF with name '+ newobj._name_+ ' already exists in the NSD_DBLEAF_BRANCH ' +self._name_+ '. Names must be unique within a branch.')
             
+            # now have to reconcile possibly different metadata structures, once for the whole batch
+            firstnew=len(md)
+            if isinstance(md,nsd_metadatacolumns):
+                md=md.copy()
+            md,changed=nsd_mergemetadata(md,[newobj.metadatastruct() for newobj in newobjs])
+                    
+            # now deal with saving metadata and the objects
+            if int(self._memory_):
+                self.__mdmemory__=md
+                self.__leaf__.extend(newobjs)
+                self.markdirty([newobj._objectfilename_ for newobj in newobjs])
+            else:
+                #write the objects to our unique subdirectory; our lock covers them
+                self.writeleaves(newobjs)
+                #now write md back to disk
+                self.commitmetadata({'add':md[firstnew:]},md)
+            # only now that the entries are saved may the index point at them
+            if changed:
+                self.clearindex()
+            else:
+                self.indexrows({i:md[i] for i in range(firstnew,len(md))})
+
     def remove(self,objectfilename):
-       '''REMOVE - Remove an item from an NSD_DBLEAF_BRANCH
-       Removes the object with the object file name equal to OBJECTFILENAME from NSD_DBLEAF_BRANCH_OBJ.'''
-       b=self.lock()
-       if not b:
-           raise Exception('Tried to lock metadata but the file was in use! Error! Delete ' +self.lockfilename(self._path_) +' if a program was interrupted while writing metadata.')
-       [index,md]=self.search('_objectfilename_',objectfilename)
-       if not index:
-           self.unlock()
-           raise Exception('No such object '+ objectfilename +'.')
-       tokeep=list(set(range(len(md))).symmetric_difference(set(index)))
-       md=list(np.array(md)[tokeep])
-       
-       if int(self._memory_):#update memory
-          self.__mdmemory__=md
-          self.__leaf__=self.__leaf__(tokeep)
-       else:
-           # update the file
-           self.writeobjectfile(self._path_,1,md)
-           # delete the leaf from disk
-           theleaf=nsd_pickdbleaf(self.dirname()+'/'+objectfilename)
-           theleaf.deleteobjectfile(self.dirname())  
-       self.unlock()
+        '''REMOVE - Remove an item from an NSD_DBLEAF_BRANCH
+        Removes the object with the object file name equal to OBJECTFILENAME from NSD_DBLEAF_BRANCH_OBJ.'''
+        with self.locked():
+            [index,md]=self.search('_objectfilename_',objectfilename)
+            if not index:
+                raise Exception('No such object '+ objectfilename +'.')
+            removed=index
+            tokeep=sorted(set(range(len(md))).difference(set(index)))
+            if isinstance(md,nsd_metadatacolumns):
+                md=md.take(tokeep)
+            else:
+                md=[md[i] for i in tokeep]
+            self.clearindex() # positions have shifted
+            
+            if int(self._memory_):#update memory
+                self.__mdmemory__=md
+                self.__leaf__=self.__leaf__.take(tokeep)
+                self.markdirty(deleted=[objectfilename])
+            else:
+                # update the file
+                self.commitmetadata({'remove':removed},md)
+                # delete the leaf from disk
+                self.deleteleaves([objectfilename])
     
     def update(self,nsd_dbleaf_obj):
         '''UPDATE - update the contents of a NSD_DBLEAF object that is stored in an NSD_DBLEAF_BRANCH
         Update the record of an NSD_DBLEAF object that is already stored in a NSD_DBLEAF_BRANCH'''
         
         #need to lock
-        b=self.lock()
-        if not b:
-            raise Exception('Could not obtain lock on object '+ self._objectfilename_ +'.')
-        [index,md] = self.search('_objectfilename_', nsd_dbleaf_obj._objectfilename_)
-        if not index:
-            self.unlock()
-            raise Exception('The object to be updated is not in this branch: ' +nsd_dbleaf_obj._objectfilename_+' is not in '+ self._objectfilename_+ '.')
-        # we assume that metadata field identities haven't changed
-        omd=metadatastruct(nsd_dbleaf_obj)
-        md[index] = structmerge(md[index],omd)
-        if int(self._memory_):
-            self.__mdmemory__ = md
-            self.__leaf__[index]=nsd_dbleaf_obj
-        else:
-            # write the object to our unique subdirectory
-            nsd_dbleaf_obj.writeobjectfile(self.dirname(),1)
-            # now write md back to disk
-            self.writeobjectfile([],1,md)
-        self.unlock()
+        with self.locked():
+            [index,md] = self.search('_objectfilename_', nsd_dbleaf_obj._objectfilename_)
+            if not index:
+                raise Exception('The object to be updated is not in this branch: ' +nsd_dbleaf_obj._objectfilename_+' is not in '+ self._objectfilename_+ '.')
+            # we assume that metadata field identities haven't changed
+            index=index[0]
+            omd=nsd_dbleaf_obj.metadatastruct()
+            if isinstance(md,nsd_metadatacolumns) or not self.inmemory():
+                md=md.copy() # the MD of SEARCH is shared with the cache
+            oldmd=dict(md[index])
+            md[index] = structmerge(oldmd,omd)
+            if int(self._memory_):
+                self.__mdmemory__ = md
+                self.__leaf__[index]=nsd_dbleaf_obj
+                self.markdirty([nsd_dbleaf_obj._objectfilename_])
+            else:
+                # write the object to our unique subdirectory, then md back to disk
+                self.writeleaves([nsd_dbleaf_obj])
+                self.commitmetadata({'update':{index:dict(md[index])}},md)
+                filename=self.leaffilename(nsd_dbleaf_obj._objectfilename_)
+                segment=self.segment()
+                where=segment.locate(nsd_dbleaf_obj._objectfilename_) if segment is not None else None
+                if where is None:
+                    nsd_leafcache.put(filename,nsd_dbleaf_obj)
+                else:
+                    if os.path.isfile(filename):
+                        os.remove(filename) # written before the branch was PACKED
+                    nsd_leafcache.store(filename,where[0],nsd_dbleaf_obj,where[1])
+                    if segment.garbage():
+                        self.compactleaves(1)
+            # only now that the entry is saved may the index point at it
+            self.indexrows({index:md[index]},{index:oldmd})
              
+    @nsd_instrumented('search')
     def search(self, *varargin):
         ''' SEARCH - search for a match in NSD_DBLEAF_BRANCH metadata
+         [INDEXES, MD] = SEARCH(NSD_DBLEAF_BRANCH_OBJ, PARAM1, VALUE1, PARAM2, VALUE2, ...)
          Searches the metadata parameters PARAM1, PARAM2, and so on, for 
-         value1, value2, and so on. If valueN is a string, then a regular expression
-         is evaluated to determine the match. If valueN is not a string, then the
-         the items must match exactly.'''
-        md=self.metadata()
+         value1, value2, and so on; an entry must match all of the pairs. If valueN is
+         a string, then a regular expression is evaluated to determine the match (the
+         whole value must match). If valueN is not a string, then the
+         the items must match exactly. valueN may also be an NSD_SEARCHRANGE, to
+         require a number within a range, or NSD_SEARCHEXISTS, to require that the
+         parameter is present and not empty.
+         Exact matches on indexed fields (see ADDINDEXFIELD) are looked up in the field
+         index first, so that only the entries they select are checked against the
+         remaining pairs. MD is the metadata as CACHEDMETADATA returns it, shared with the
+         cache, so that a lookup does not copy it; it must not be modified.'''
+        if len(varargin)%2:
+            raise Exception('Search terms must be given as PARAM/VALUE pairs.')
+        md=self.cachedmetadata()
         if not md:
             return [],[{}]
-        indexes = []
-        for i in range(0,2,len(varargin)):
-            for j in md:
-                if not varargin[i] in list(j.keys()):
-                    raise Exception(varargin[i] +' is not a field of the metadata.')
-                if varargin[i+1]==j.get(varargin[i]):
-                    indexes.append(md.index(j))
-            else:
-                matches_here='dont know how to write'
-            indexes=list(set(indexes))
-            return indexes,md
+        columnar=isinstance(md,nsd_metadatacolumns)
+        fields=md.kinds if columnar else md[0]
+        predicates=[]
+        for i in range(0,len(varargin),2):
+            p=nsd_searchpredicate(varargin[i],varargin[i+1])
+            if not isinstance(p.value,nsd_searchexists) and not p.field in fields:
+                raise Exception(p.field +' is not a field of the metadata.')
+            predicates.append(p)
+        # pick the most selective indexed predicate to produce the candidates
+        candidates=None
+        for p in predicates:
+            if p.cost==0 and p.field in self.__indexfields__:
+                idx=self.fieldindex(p.field,md)
+                keys=p.indexkeys()
+                if len(keys)==1:
+                    bucket=idx.get(keys[0],[])
+                else:
+                    bucket=list(dict.fromkeys(i for k in keys for i in idx.get(k,[])))
+                if candidates is None or len(bucket)<len(candidates):
+                    candidates,best=bucket,p
+        if candidates is not None and len(best.indexkeys())==1:
+            predicates.remove(best) # otherwise the keys found may hold other values
+        if columnar:
+            # evaluate the remaining predicates a column at a time
+            rows=None if candidates is None else np.array(candidates,dtype=np.int64)
+            for p in sorted(predicates,key=lambda p:p.cost):
+                m=md.match(p,rows)
+                rows=np.flatnonzero(m) if rows is None else rows[m]
+                if not len(rows):
+                    break
+            if rows is None:
+                rows=np.arange(len(md))
+            return sorted(rows.tolist()),md
+        if candidates is None:
+            candidates=range(len(md))
+        # then filter the candidates, cheapest predicates first
+        for p in sorted(predicates,key=lambda p:p.cost):
+            if not candidates:
+                break
+            candidates=[i for i in candidates if p.matches(md[i])]
+        indexes=sorted(candidates)
+        return indexes,md
         
-    def load(self,*varargin):
+    def summary(self):
+        '''SUMMARY - Return an NSD_METADATASUMMARY of the metadata of an NSD_DBLEAF_BRANCH
+        The summary of a branch on disk is kept until the metadata file changes.'''
+        md=self.cachedmetadata()
+        if self.inmemory():
+            return nsd_metadatasummary(md)
+        if self.__summary__ is None or self.__summary__[0]!=self.__mdstamp__:
+            self.__summary__=[self.__mdstamp__,nsd_metadatasummary(md)]
+        return self.__summary__[1]
+
+    def subtreesummary(self):
+        '''SUBTREESUMMARY - Return an NSD_METADATASUMMARY of this branch and all the branches below it
+        For a branch on disk, the summary is kept in the file SUBTREEFILENAME, so that
+        SEARCH_TREE can rule out the whole branch without reading it (see CHILDSUMMARY). Any
+        change to the metadata of the branch, or of a branch below it, removes the file (see
+        NSD_INVALIDATESUBTREE), and the next call writes it again, from the summaries of the
+        sub-branches. The file is created empty before anything is read and filled in place
+        afterwards, so a change made meanwhile removes the file being written rather than
+        leaving a stale one. A branch in memory is summarized each time, without a file.'''
+        fname=None
+        if not self.inmemory():
+            fname=self.subtreefilename()
+            summary=nsd_loadsummary(fname,self.metadatastamp())
+            if summary is not None:
+                return summary
+            try:
+                os.remove(fname) # out of date, or still being written by a reader that may have died
+            except FileNotFoundError:
+                pass
+            try:
+                fd=os.open(fname,os.O_WRONLY|os.O_CREAT|os.O_EXCL)
+            except FileExistsError:
+                fname=None # another reader is writing it; just compute it
+        try:
+            stamp=self.metadatastamp() if fname is not None else None
+            own=self.summary()
+            summary=nsd_metadatasummary()
+            summary.merge(own)
+            for i,objectfilename in own.branches:
+                child=self.__leaf__[i] if self.inmemory() else self.loadleaf(objectfilename)
+                summary.merge(child.subtreesummary())
+        except BaseException:
+            if fname is not None:
+                os.close(fd)
+                os.remove(fname)
+            raise
+        if fname is not None:
+            with os.fdopen(fd,'w') as fid:
+                json.dump(summary.todict(stamp),fid,default=nsd_jsonvalue)
+        return summary
+
+    def childsummary(self,objectfilename):
+        '''CHILDSUMMARY - Return the SUBTREESUMMARY of the sub-branch OBJECTFILENAME from its file
+        Returns None if the sub-branch has no summary file that is up to date. The sub-branch
+        itself is not read, only the file and the status of its metadata files.'''
+        prefix=self.leafdir(objectfilename)+'/'+objectfilename
+        return nsd_loadsummary(prefix+'.subtree.dbleaf_branch.nsd',nsd_metadatastamp(prefix+'.metadata.dbleaf_branch.nsd'))
+
+    def invalidatesubtree(self,usethispath=''):
+        '''INVALIDATESUBTREE - Remove the subtree summaries of this branch and the branches above it
+        Called after the metadata of the branch was changed (see SUBTREESUMMARY).'''
+        nsd_invalidatesubtree(os.path.dirname(self.metadatafilename(usethispath)),self._objectfilename_)
+
+    def search_tree(self,*varargin,workers=8):
+        ''' SEARCH_TREE - search this NSD_DBLEAF_BRANCH and all of the branches below it
+         HITS = SEARCH_TREE(NSD_DBLEAF_BRANCH_OBJ, PARAM1, VALUE1, PARAM2, VALUE2, ...)
+         Searches every branch of the tree that starts at NSD_DBLEAF_BRANCH_OBJ as SEARCH does.
+         Returns a sorted list of (BRANCHPATH, INDEX) pairs, where BRANCHPATH is the names of
+         the branches from this one down to the branch with the match, separated by '/', and
+         INDEX is the index of the match in the metadata of that branch.
+         The branches are visited by a pool of WORKERS threads. A branch is only searched if
+         its SUMMARY shows that an entry could match. A sub-branch on disk is skipped, with all
+         of the branches below it and without being read, if its SUBTREESUMMARY shows that no
+         entry in it can match; the first search of a subtree writes these summaries. The
+         sub-branches of a branch in memory are visited either way.'''
+        if len(varargin)%2:
+            raise Exception('Search terms must be given as PARAM/VALUE pairs.')
+        predicates=[nsd_searchpredicate(varargin[i],varargin[i+1]) for i in range(0,len(varargin),2)]
+        def visit(branch,path):
+            summary=branch.summary()
+            hits=[]
+            if all(summary.mightmatch(p) for p in predicates):
+                indexes,md=branch.search(*varargin)
+                hits=[(path,i) for i in indexes]
+            children=[]
+            for i,objectfilename in summary.branches:
+                if branch.inmemory():
+                    child=branch.__leaf__[i]
+                else:
+                    sub=branch.childsummary(objectfilename)
+                    if sub is not None and not all(sub.mightmatch(p) for p in predicates):
+                        continue # nothing below can match; the sub-branch is not even read
+                    child=branch.loadleaf(objectfilename)
+                    if sub is None and not all(child.subtreesummary().mightmatch(p) for p in predicates):
+                        continue
+                children.append((child,path+'/'+child._name_))
+            return hits,children
+        hits=[]
+        with concurrent.futures.ThreadPoolExecutor(max(workers,1)) as pool:
+            pending={pool.submit(visit,self,self._name_)}
+            while pending:
+                done,pending=concurrent.futures.wait(pending,return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    found,children=future.result()
+                    hits.extend(found)
+                    pending.update(pool.submit(visit,*child) for child in children)
+        hits.sort()
+        return hits
+
+    def load(self,*varargin,workers=0,processes=0):
         ''' LOAD - Load an object(s) from an NSD_DBLEAF_BRANCH
          Returns the object(s) in the NSD_DBLEAF_BRANCH NSD_DBLEAF_BRANCH_OBJ at index(es) INDEXES or
          searches for an object whose metadata parameters PARAMS1, PARAMS2, and so on, match
          VALUE1, VALUE2, and so on (see NSD_DBLEAF_BRANCH/SEARCH).
          If more than one object is requested, then OBJ will be a cell list of matching objects.
-         Otherwise, the object will be a single element. If there are no matches, empty ([]) is returned.'''
+         Otherwise, the object will be a single element. If there are no matches, empty ([]) is returned.
+         Objects are read through NSD_LEAFCACHE; each load returns a new copy of the object,
+         so changes to it are only seen by others once they are stored with UPDATE.
+
+         WORKERS > 1 reads the object files with that many threads (or, if PROCESSES is 1,
+         processes); the objects are still returned in the order of INDEXES. See LOAD_ITER.'''
+        obj=list(self.load_iter(*varargin,workers=workers,processes=processes))
+        if not obj:
+            obj=[None]
+        return obj
+
+    def load_iter(self,*varargin,workers=0,processes=0):
+        '''LOAD_ITER - Load objects from an NSD_DBLEAF_BRANCH one at a time
+         Takes the same arguments as LOAD, but is a generator that yields the objects in the
+         order of INDEXES as they are read.
+         If WORKERS > 1, the object files are read by a pool of WORKERS threads, at most
+         2*WORKERS files ahead of the object being yielded, so that the latency of opening
+         many files overlaps. With PROCESSES=1 the pool is a pool of processes instead, which
+         helps leaf types that are expensive to parse; their objects must be picklable.
+         Stopping the generator early cancels the reads that have not started.'''
         md=[]
         if len(varargin)>=2:
             [indexes, md] = self.search(*varargin)
         else:
             indexes=varargin[0]
-            
-        if indexes:
-            if not md:
-                md = self.metadata()
-            obj=[]
-            for i in range(len(indexes)):
-                if self._path_:
-                    obj.append(nsd_pickdbleaf(self.dirname()+'/'+md[indexes[i]].get('_objectfilename_')))
-                else:
-                    obj.append(self.__leaf__(indexes[i]))
-            
-        else:
-            obj=[None]
-        return obj
+        if not indexes:
+            return
+        if self.inmemory():
+            for i in indexes:
+                yield self.__leaf__[i]
+            return
+        if not md:
+            md = self.cachedmetadata()
+        yield from self.readleaves([md[i].get('_objectfilename_') for i in indexes],workers,processes)
     
+    def iter_metadata(self,chunk=1024):
+        '''ITER_METADATA - Generator of the metadata entries of an NSD_DBLEAF_BRANCH
+         Yields the metadata structure of each entry, in order.
+         If the branch is in memory or its metadata is already cached, the entries come from
+         that copy. A binary metadata file without a journal is memory-mapped and converted
+         to dictionaries CHUNK entries at a time, so memory use does not grow with the size
+         of the branch and stopping early reads no more than is needed. A text metadata file,
+         or one with a journal to replay, has to be read whole first (see METADATA).
+         The entries are those of the metadata file when the generator started.'''
+        if not self.inmemory():
+            stamp=self.metadatastamp()
+            if stamp is None:
+                return
+            if (self.__mdcache__ is None or stamp!=self.__mdstamp__) and stamp[2] is None:
+                md=None
+                if nsd_binarymetadataheader(self.metadatafilename()) is not None:
+                    try:
+                        md=nsd_readbinarymetadata(self.metadatafilename())
+                    except OSError:
+                        pass # replaced by a text file or removed since; read it whole below
+                if md is not None and self.metadatastamp()[2] is None:
+                    for start in range(0,len(md),chunk):
+                        yield from md[start:start+chunk]
+                    return
+        md=self.cachedmetadata()
+        if isinstance(md,nsd_metadatacolumns):
+            for start in range(0,len(md),chunk):
+                yield from md[start:start+chunk]
+        else:
+            yield from md
+
+    def iter_leaves(self,*varargin,workers=0,processes=0,chunk=1024):
+        '''ITER_LEAVES - Generator of the objects of an NSD_DBLEAF_BRANCH that match a search
+         Yields, in order, the objects whose metadata match PARAM1, VALUE1, PARAM2, VALUE2, ...
+         (see SEARCH), or all objects if no pairs are given. The metadata are streamed with
+         ITER_METADATA(CHUNK) and the matching objects are read as they are found, by WORKERS
+         threads or processes as in LOAD_ITER, so the whole branch is never held in memory.
+         Unlike SEARCH, a PARAM that is not a field of the metadata matches nothing.'''
+        if len(varargin)%2:
+            raise Exception('Search terms must be given as PARAM/VALUE pairs.')
+        predicates=[nsd_searchpredicate(varargin[i],varargin[i+1]) for i in range(0,len(varargin),2)]
+        predicates.sort(key=lambda p:p.cost)
+        if self.inmemory():
+            for i,row in enumerate(self.iter_metadata(chunk)):
+                if all(p.matches(row) for p in predicates):
+                    yield self.__leaf__[i]
+            return
+        objectfilenames=(row.get('_objectfilename_') for row in self.iter_metadata(chunk)
+            if all(p.matches(row) for p in predicates))
+        yield from self.readleaves(objectfilenames,workers,processes)
+
+    def loadleaf(self,objectfilename):
+        '''LOADLEAF - Read one object of an NSD_DBLEAF_BRANCH from its object file
+        Returns the object stored in OBJECTFILENAME in the subdirectory of the branch (or in
+        its segment, see PACKED), from NSD_LEAFCACHE if it has not changed since it was last read.'''
+        return next(self.readleaves([objectfilename]))
+
+    def readleaves(self,objectfilenames,workers=0,processes=0,usethispath='',cache=1):
+        '''READLEAVES - Generator of the objects OBJECTFILENAMES of an NSD_DBLEAF_BRANCH, in order
+        Objects in the segment of the branch (see PACKED) are read from its memory map, the
+        records of a list of OBJECTFILENAMES being read ahead in file order; other objects are
+        read from their object files, by WORKERS threads or processes (see LOAD_ITER) if the
+        branch has no segment. Objects are read through NSD_LEAFCACHE unless CACHE is 0.'''
+        segment=self.segment(usethispath)
+        if segment is None or not len(segment):
+            filenames=(self.leaffilename(f,usethispath) for f in objectfilenames)
+            if cache:
+                yield from nsd_readleaves(filenames,workers,processes)
+            else:
+                for f in filenames:
+                    yield nsd_pickdbleaf(f)
+            return
+        if isinstance(objectfilenames,list) and len(objectfilenames)>1:
+            segment.prefetch(objectfilenames)
+        for f in objectfilenames:
+            filename=self.leaffilename(f,usethispath)
+            where=segment.locate(f)
+            if where is None:
+                yield nsd_leafcache.get(filename) if cache else nsd_pickdbleaf(filename)
+            elif cache:
+                yield nsd_leafcache.get(filename,where[0],where[1],lambda f=f,filename=filename: nsd_leaffromtext(segment.read(f),filename))
+            else:
+                yield nsd_leaffromtext(segment.read(f),filename)
+
+    def writeleaves(self,leaves,usethispath=''):
+        '''WRITELEAVES - Write the objects LEAVES of an NSD_DBLEAF_BRANCH to disk
+        If the branch is PACKED, the objects that can be packed (see NSD_PACKABLE) are appended
+        to its segment in one write; the others are written to their object files in the
+        subdirectory of the branch. The caller must hold the lock.'''
+        packed=[]
+        for leaf in leaves:
+            if int(self._packed_) and nsd_packable(leaf):
+                packed.append([leaf._objectfilename_,nsd_objecttext(leaf)])
+            else:
+                leaf.writeobjectfile(self.leafdir(leaf._objectfilename_,usethispath),1)
+        if packed:
+            nsd_openleafsegment(self.segmentfilename(usethispath)).append(packed)
+
+    def deleteleaves(self,objectfilenames,usethispath=''):
+        '''DELETELEAVES - Delete the objects OBJECTFILENAMES of an NSD_DBLEAF_BRANCH from disk
+        Objects in the segment of the branch are marked as removed there; the object files of
+        the others are deleted (with their subdirectories, for sub-branches). Objects that are
+        not on disk are skipped. A branch on disk starts a background COMPACTLEAVES when enough
+        of its segment is dead. The caller must hold the lock.'''
+        segment=self.segment(usethispath)
+        removed=[]
+        for f in objectfilenames:
+            filename=self.leaffilename(f,usethispath)
+            if segment is not None and segment.locate(f) is not None:
+                removed.append([f,None])
+            elif os.path.isfile(filename):
+                nsd_leafcache.get(filename).deleteobjectfile(self.leafdir(f,usethispath))
+            nsd_leafcache.invalidate(filename)
+        if removed:
+            segment.append(removed)
+            if not self.inmemory() and segment.garbage():
+                self.compactleaves(1)
+
+    def segmentfilename(self,usethispath=''):
+        '''SEGMENTFILENAME - Return the (full path) name of the segment file of an NSD_DBLEAF_BRANCH
+        The segment file holds the objects of a PACKED branch (see NSD_LEAFSEGMENT).'''
+        return self.metadatafilename(usethispath)[:-len('.metadata.dbleaf_branch.nsd')]+'.segment.dbleaf_branch.nsd'
+
+    def subtreefilename(self,usethispath=''):
+        '''SUBTREEFILENAME - Return the (full path) name of the subtree summary file of an NSD_DBLEAF_BRANCH
+        The file holds the SUBTREESUMMARY of the branch.'''
+        return self.metadatafilename(usethispath)[:-len('.metadata.dbleaf_branch.nsd')]+'.subtree.dbleaf_branch.nsd'
+
+    def segment(self,usethispath=''):
+        '''SEGMENT - Return the up-to-date NSD_LEAFSEGMENT of an NSD_DBLEAF_BRANCH
+        Returns None if the branch is not PACKED and has no segment file.'''
+        if int(self._memory_) and not usethispath:
+            return None
+        fname=self.segmentfilename(usethispath)
+        if not int(self._packed_) and not os.path.isfile(fname):
+            return None
+        return nsd_openleafsegment(fname).refresh()
+
+    def compactleaves(self,background=0):
+        '''COMPACTLEAVES - Drop the replaced and removed objects from the segment of an NSD_DBLEAF_BRANCH
+        The live objects are copied to a new segment file (see NSD_LEAFSEGMENT/COMPACT); the
+        lock is only taken at the end, to carry over objects written during the copy, so the
+        branch can be used meanwhile. With BACKGROUND=1 the copy is made by a thread and
+        COMPACTLEAVES returns at once; if a compaction is already running, nothing is done.
+        An error in the thread is kept until the next COMPACTLEAVES with BACKGROUND=0, or
+        CLOSE, which raise it; it is not raised by the background compactions that REMOVE and
+        UPDATE start, as their changes are already saved by then.
+        A branch in memory compacts the segment it was last saved to (see FLUSH).'''
+        if background:
+            if self.__compactor__ is None or not self.__compactor__.is_alive():
+                self.__compactor__=threading.Thread(target=self.compactionthread,daemon=True,
+                    name='nsd_dbleaf_branch compaction '+self._name_)
+                self.__compactor__.start()
+            return
+        error,self.__compacterror__=self.__compacterror__,None
+        if error is not None:
+            raise error
+        self.compactsegment()
+
+    def compactsegment(self):
+        '''COMPACTSEGMENT - Compact the segment of the branch in the calling thread (see COMPACTLEAVES)
+        A branch in memory appends to its segment in FLUSH, which holds the flush lock but not
+        the lock of the branch while it writes, so the compaction is finished under both.'''
+        if int(self._memory_):
+            segment=self.segment(self.__saveddir__)
+            locked=self.flushlocked
+        else:
+            segment=self.segment()
+            locked=self.locked
+        if segment is not None:
+            segment.compact(locked)
+
+    def compactionthread(self):
+        '''COMPACTIONTHREAD - The body of the thread of COMPACTLEAVES(BACKGROUND=1)'''
+        try:
+            self.compactsegment()
+        except Exception as e:
+            self.__compacterror__=e
+
     def numitems(self):
         '''NUMITEMS - Number of items in this level of an NSD_DBLEAF_BRANCH
         Returns the number of items in the NSD_DBLEAF_BRANCH object.'''
-        md=self.metadata()
+        if not self.inmemory():
+            stamp=self.metadatastamp()
+            if stamp is None:
+                return 0
+            if self.__mdcache__ is not None and stamp==self.__mdstamp__:
+                return len(self.__mdcache__)
+            if stamp[2] is None:
+                # a binary metadata file (with no journal) has the count in its header
+                header=nsd_binarymetadataheader(self.metadatafilename())
+                if header is not None:
+                    return header[2]
+        md=self.cachedmetadata()
         n=len(md)
         return n
     
+    @nsd_instrumented('branch.writeobjectfile')
     def writeobjectfile(self,thedirname=[], locked=0, metad=1):
         '''WRITEOBJECTFILE - write the object data to the disk
-        Writes the object data of NSD_DBLEAF_BRANCH object NSD_DBLEAF_BRANCH_OBJ to disk.'''
+        Writes the object data of NSD_DBLEAF_BRANCH object NSD_DBLEAF_BRANCH_OBJ to disk.
+        Only what changed is written: the metadata file is left alone if it already holds the
+        metadata (METAD=1) and has no journal, the object file of the branch if its properties
+        did not change, and a branch in memory writes the leaves that changed since it was last
+        saved to THEDIRNAME (see FLUSH). If METAD is given, the metadata file is rewritten.'''
         if not thedirname:
             if int(self._memory_):
                 raise Exception('This branch '+ self._name_ +' has no path. THEDIRNAME must be provided.')
             thedirname=self._path_
-        if metad==1:
-            metad=self.metadata()
+        if int(self._memory_) and metad==1:
+            # the metadata, the leaves that changed and our object data; FLUSH takes its own
+            # locks, and must take the flush lock before the lock of the branch
+            self.flush(thedirname)
+            return
         b=1
         # now we have to proceed in 4 steps
         # a) obtain the lock so we know nobody else is going to be writing our files
@@ -267,25 +959,242 @@ class nsd_dbleaf_branch(nsd_dbleaf):
         if not locked:
             b=self.lock(thedirname)
         if not b:
-            raise Exception('Tried to write metadata but the file was in use! Error! Delete ' +self.lockfilename(thedirname) +' if a program was interrupted while writing metadata.')
-        if metad:
-            saveStructArray(self.metadatafilename(),metad)
-        else:
-            if os.path.isfile(self.metadatafilename()):
-                os.remove(self.metadatafilename())
-        # now, if in memory, write leaf objects
-        if int(self._memory_):
-            # remove our subdirectory, it is guaranteed to exist after .dirname() runs
-            shutil.rmtree(self.dirname(thedirname))
-            for i in range(leng(self.__leaf__)):
-                self.__leaf__(i).writeobjectfile(self.dirname(thedirname))
-        # now write our object data
-        super(nsd_dbleaf_branch,self).writeobjectfile(thedirname,1)
-        if not locked:
-            b=self.unlock(thedirname)
-            if not b:
-                raise Exception('yikes! could not remove lock!')
+            raise Exception('Tried to write metadata but the lock could not be obtained. ' +self.lockholder(thedirname))
+        try:
+            if metad==1:
+                metad=self.metadata()
+                if not self.metadatasaved(thedirname):
+                    self.writemetadatafile(thedirname,metad)
+            else:
+                self.writemetadatafile(thedirname,metad)
+                if int(self._memory_):
+                    self.__mddirty__=0
+            if not metad:
+                self.clearindex()
+            self.cachemetadata(metad if metad else [])
+            # now write our object data
+            self.writeownobjectfile(thedirname)
+        finally:
+            if not locked:
+                self.unlock(thedirname)
                 
+    def metadatasaved(self,thedirname):
+        '''METADATASAVED - Does the metadata file in THEDIRNAME hold the current metadata?
+        True for a branch on disk whose metadata file has not changed since it was last read
+        or written, has no journal, and is in the format that the branch writes.'''
+        if int(self._memory_) or thedirname!=self._path_ or self.__mdcache__ is None:
+            return False
+        stamp=self.metadatastamp()
+        if stamp is None:
+            return not self.__mdcache__
+        if stamp!=self.__mdstamp__ or stamp[2] is not None or self.generation()%2:
+            return False
+        if self.__binary__ is not None:
+            return bool(self.__binary__)==(nsd_binarymetadataheader(self.metadatafilename()) is not None)
+        return True
+
+    def writeownobjectfile(self,thedirname):
+        '''WRITEOWNOBJECTFILE - Write the object file of the branch itself, if it changed
+        The file is not written again if the properties of the branch are the same as when it
+        was last written and the file has not been changed since.'''
+        data,fieldnames=self.stringdatatosave()
+        text='\n'.join(data)
+        fname=thedirname+'/'+self._objectfilename_
+        try:
+            st=os.stat(fname)
+            stamp=(st.st_mtime_ns,st.st_size)
+        except OSError:
+            stamp=None
+        if self.__savedobject__==[fname,text,stamp]:
+            return
+        super(nsd_dbleaf_branch,self).writeobjectfile(thedirname,1)
+        st=os.stat(fname)
+        self.__savedobject__=[fname,text,(st.st_mtime_ns,st.st_size)]
+
+    def writemetadatafile(self,thedirname,metad):
+        '''WRITEMETADATAFILE - Replace the metadata file in THEDIRNAME with the metadata METAD
+        The file is removed if METAD is empty, and any journal is dropped, as it is contained in
+        the new file. Readers see an odd generation while this happens (see GENERATION).
+        The caller must hold the lock.'''
+        mdfname=self.metadatafilename(thedirname)
+        # readers see an odd generation while the metadata file and journal are replaced
+        generation=self.generation()
+        generation+=1-generation%2
+        self.setgeneration(generation,thedirname)
+        if metad:
+            binary=self.__binary__
+            if binary is None:
+                binary=nsd_binarymetadataheader(mdfname) is not None
+            if binary:
+                nsd_writebinarymetadata(mdfname,metad)
+            else:
+                tmpname=nsd_tempfilename(mdfname)
+                if isinstance(metad,nsd_metadatacolumns):
+                    nsd_stats.call('saveStructArray',saveStructArray,tmpname,metad.tolist())
+                else:
+                    nsd_stats.call('saveStructArray',saveStructArray,tmpname,metad)
+                if nsd_stats.enabled:
+                    nsd_stats.record('saveStructArray',byteswritten=os.path.getsize(tmpname),calls=0)
+                nsd_replacefile(tmpname,mdfname)
+        elif os.path.isfile(mdfname):
+            os.remove(mdfname)
+        # the journal is now contained in the metadata file
+        if os.path.isfile(self.journalfilename(thedirname)):
+            os.remove(self.journalfilename(thedirname))
+        self.setgeneration(generation+1,thedirname)
+        self.invalidatesubtree(thedirname)
+
+    def markdirty(self,objectfilenames=(),deleted=()):
+        '''MARKDIRTY - Record changes to a branch in memory that FLUSH has to write
+        OBJECTFILENAMES are leaves that were added or updated and DELETED are leaves that were
+        removed; the metadata is marked as changed in either case. Wakes the WRITEBEHIND
+        thread if there are MAXDIRTY or more changed leaves.'''
+        self.__dirty__.update(objectfilenames)
+        self.__deleted__.update(deleted)
+        self.__dirty__.difference_update(deleted)
+        self.__mddirty__=1
+        flusher=self.__flusher__
+        if flusher is not None and len(self.__dirty__)+len(self.__deleted__)>=flusher[5]:
+            flusher[2].set()
+
+    def flush(self,thedirname=''):
+        '''FLUSH - Write the changes to a branch in memory to disk
+        Writes the leaves that were added or updated and the metadata, and deletes the object
+        files of the leaves that were removed, since the last FLUSH, into THEDIRNAME (by default
+        the directory of WRITEBEHIND, or the path of the branch). Unlike WRITEOBJECTFILE, the
+        leaves that did not change are left alone. The object file of the branch itself is
+        written if its properties changed. Raises the error of a failed background flush, if any.
+        Changes made while FLUSH is writing are left for the next FLUSH.
+        Changes are tracked for one directory: the first FLUSH into a directory, or one into a
+        different directory than the last, writes the whole branch there.
+        FLUSH takes the flush lock and then the lock of the branch, so it may not be called by
+        a thread that holds the lock of the branch (that would deadlock with WRITEBEHIND).'''
+        lockfid=self.__lockfid__.get(None)
+        if lockfid is not None and lockfid.ismine():
+            raise Exception('FLUSH of the branch '+ self._name_ +' was called with the lock of the branch held; release it first.')
+        error,self.__flusherror__=self.__flusherror__,None
+        if error is not None:
+            raise error
+        if not thedirname:
+            thedirname=self.__saveddir__ or self._path_
+        if not thedirname:
+            raise Exception('This branch '+ self._name_ +' has no path. THEDIRNAME must be provided.')
+        flushlock=self.__lockfid__.setdefault('flush',nsd_lockfile(None)) # one FLUSH at a time
+        if not flushlock.acquire():
+            raise Exception('Could not start to flush the branch '+ self._name_ +'; another flush is taking too long.')
+        try:
+            with self.locked():
+                full=thedirname!=self.__saveddir__
+                if full:
+                    self.__dirty__.clear()
+                    self.__deleted__.clear()
+                    self.__mddirty__=1
+                dirty,self.__dirty__=self.__dirty__,set()
+                deleted,self.__deleted__=self.__deleted__,set()
+                mddirty,self.__mddirty__=self.__mddirty__,0
+                md=self.metadata()
+                md=md.copy() if isinstance(md,nsd_metadatacolumns) else list(md)
+                if full:
+                    leaves=list(self.__leaf__)
+                else:
+                    index=self.fieldindex('_objectfilename_',md)
+                    leaves=[self.__leaf__[index[f][0]] for f in dirty if f in index]
+            try:
+                if full:
+                    # start from an empty subdirectory, as we do not know what is in it
+                    shutil.rmtree(self.dirname(thedirname),ignore_errors=True)
+                    self.__dirnames__.clear()
+                    if os.path.isfile(self.segmentfilename(thedirname)):
+                        os.remove(self.segmentfilename(thedirname))
+                    for leaf in leaves:
+                        if isinstance(leaf,nsd_dbleaf_branch):
+                            leaf.__saveddir__=None # its files went with the subdirectory
+                # leaves first and deletions last, so the metadata file never names a missing leaf
+                self.writeleaves(leaves,thedirname)
+                if mddirty or not os.path.isfile(self.metadatafilename(thedirname)):
+                    self.writemetadatafile(thedirname,md)
+                self.deleteleaves(deleted,thedirname)
+                self.writeownobjectfile(thedirname)
+                if full:
+                    self.__saveddir__=thedirname
+            except BaseException:
+                # try again next time
+                with self.locked():
+                    if full:
+                        self.__saveddir__=None
+                    self.__dirty__.update(dirty.difference(self.__deleted__))
+                    self.__deleted__.update(deleted.difference(self.__dirty__))
+                    self.__mddirty__|=mddirty
+                raise
+        finally:
+            flushlock.release()
+
+    @contextlib.contextmanager
+    def flushlocked(self):
+        '''FLUSHLOCKED - Hold the flush lock and then the lock of the branch for a WITH block
+        Nothing else can write to the files of a branch in memory meanwhile, not even FLUSH.
+        As for FLUSH, the calling thread may not already hold the lock of the branch.'''
+        lockfid=self.__lockfid__.get(None)
+        if lockfid is not None and lockfid.ismine():
+            raise Exception('The flush lock of the branch '+ self._name_ +' was asked for with the lock of the branch held; release it first.')
+        flushlock=self.__lockfid__.setdefault('flush',nsd_lockfile(None))
+        if not flushlock.acquire():
+            raise Exception('Could not obtain the flush lock of the branch '+ self._name_ +'; a flush is taking too long.')
+        try:
+            with self.locked():
+                yield self
+        finally:
+            flushlock.release()
+
+    def writebehind(self,thedirname='',interval=1.0,maxdirty=1000):
+        '''WRITEBEHIND - Save a branch in memory to disk in the background
+        Starts a thread that calls FLUSH(THEDIRNAME) every INTERVAL seconds, and as soon as
+        MAXDIRTY leaves have changed, so that only the changes are written and ADD, UPDATE and
+        REMOVE keep the speed of a branch in memory. THEDIRNAME is the path of the branch by
+        default. Use FLUSH to make the changes durable at a given point and CLOSE to stop the
+        thread. An error in the thread is raised by the next FLUSH or CLOSE.'''
+        if not int(self._memory_):
+            raise Exception('Only a branch in memory (MEMORY=1) can be written behind.')
+        if not thedirname:
+            thedirname=self._path_
+        if not thedirname:
+            raise Exception('This branch '+ self._name_ +' has no path. THEDIRNAME must be provided.')
+        self.close()
+        stop=threading.Event()
+        wake=threading.Event()
+        thread=threading.Thread(target=self.flushloop,args=(stop,wake,thedirname,interval),daemon=True,
+            name='nsd_dbleaf_branch writebehind '+self._name_)
+        self.__flusher__=[thread,stop,wake,thedirname,interval,maxdirty]
+        thread.start()
+
+    def flushloop(self,stop,wake,thedirname,interval):
+        '''FLUSHLOOP - The loop of the WRITEBEHIND thread'''
+        while not stop.is_set():
+            wake.wait(interval)
+            wake.clear()
+            if stop.is_set():
+                break
+            try:
+                self.flush(thedirname)
+            except Exception as e:
+                self.__flusherror__=e
+
+    def close(self):
+        '''CLOSE - Stop the WRITEBEHIND thread, if any, and FLUSH the remaining changes
+        Also waits for a background COMPACTLEAVES to finish, and raises its error, if any.'''
+        flusher,self.__flusher__=self.__flusher__,None
+        if flusher is not None:
+            flusher[1].set()
+            flusher[2].set()
+            flusher[0].join()
+            self.flush(flusher[3])
+        compactor,self.__compactor__=self.__compactor__,None
+        if compactor is not None:
+            compactor.join()
+        error,self.__compacterror__=self.__compacterror__,None
+        if error is not None:
+            raise error
+
     def stringdatatosave(self):
         '''STRINGDATATOSAVE - Returns a set of strings to write to file to save object information
         Return a cell array of strings to save to the objectfilename'''
@@ -294,6 +1203,19 @@ class nsd_dbleaf_branch(nsd_dbleaf):
         fieldnames.append('$memory')
         data.append(str(self._classnames_))
         fieldnames.append('$classnames')
+        data.append(str(self._isflat_))
+        fieldnames.append('$isflat')
+        data.append(str(self._layout_))
+        fieldnames.append('$layout')
+        data.append(str(self._packed_))
+        fieldnames.append('$packed')
+        # options that are kept in private properties (see SETPROPERTIES)
+        data.append(str(self.__journal__))
+        fieldnames.append('$journal')
+        data.append(str(self.__columnar__))
+        fieldnames.append('$columnar')
+        data.append(str(self.__leaf__.compact))
+        fieldnames.append('$compact')
         return data,fieldnames
     
     def setproperties(self, properties, values):
@@ -302,75 +1224,84 @@ class nsd_dbleaf_branch(nsd_dbleaf):
          VALUES, sets the fields in NSD_DBLEAF_BRANCH_OBJ and returns the result in OBJ.
          If any entries in PROPERTIES are not properties of NSD_DBLEAF_BRANCH_OBJ, then
          that property is skipped.
-         the properties that are actually set are returned in PROPERTIESSET.'''
-        fn=list(self.__dict__.keys())
-        reg=re.compile(r'_\w+_')
-        fn=list(filter(reg.match,fn))
+         the properties that are actually set are returned in PROPERTIESSET.
+         Values are converted to the types in NSD_DBLEAF_BRANCH.FIELDTYPES (see NSD_BASE/FIELDTABLE).
+         The options JOURNAL, COLUMNAR and COMPACT of the constructor are set by the
+         properties '$journal', '$columnar' and '$compact'.'''
         obj=self
-        properties_set=[]
-        for i in range(len(properties)):
-            if properties[i].startswith('$'):
-                properties[i]='_'+properties[i][1:]+'_'
-        for i in range(len(properties)):
-            if properties[i] in fn:
-               exec('self.'+properties[i]+'="'+values[i]+'"')
-               properties_set.append(properties[i])
-        ind=np.where(np.array(properties)=='path')[0]
-        if ind:
-            subdirname = obj.dirname()
-            subobjs = load(obj,'_name_','(.*)')
+        properties=list(properties)
+        values=list(values)
+        options_set=[]
+        for option in ('$journal','$columnar','$compact'):
+            if option in properties:
+                i=properties.index(option)
+                value=nsd_decodeint(values[i])
+                if option=='$journal':
+                    self.__journal__=value
+                elif option=='$columnar':
+                    self.__columnar__=value
+                else:
+                    self.__leaf__.compact=value
+                options_set.append(option)
+                del properties[i]
+                del values[i]
+        properties_set=super(nsd_dbleaf_branch,self).setproperties(properties,values)+options_set
+        if '_path_' in properties_set:
+            subobjs = obj.load('_name_','(.*)')
             for j in range(len(subobjs)):
                 if isinstance(subobjs[j],nsd_dbleaf_branch):
-                    subobjs[j]=subobjs[j].setproperties('path',subdirname)
-                    obj=obj.update(subobjs[j])
+                    subobjs[j]=subobjs[j].setproperties(['_path_'],[obj.leafdir(subobjs[j]._objectfilename_)])[0]
+                    obj.update(subobjs[j])
         return [obj,properties_set]
     
     def readobjectfile(self,fname):
-        '''Reads the NSD_DBLEAF_BRANCH_OBJ from the file FNAME (full path).'''
+        '''Reads the NSD_DBLEAF_BRANCH_OBJ from the file FNAME (full path).
+        FNAME may also be an open file; then the path of the branch is taken from its NAME.'''
         obj=super(nsd_dbleaf_branch,self).readobjectfile(fname)
+        if not isinstance(fname,str):
+            fname=getattr(fname,'name','')
         [obj._path_,filename]=os.path.split(fname)
         # now, if in memory only, we need to read in the metadata and leafs
         if int(obj._memory_):
             [parent,myfile]=os.path.split(fname)
-            obj.__mdmemory__=loadStructArray(obj.metadatafilename(parent))
-            obj.__leaf__=[]
-            for i in range(len(obj.__mdmemory__)):
-                obj.__leaf__[i]=self.readobjectfile(obj.dirname(parent) +'/'+ obj.__mdmemory__[i].get('_objectfilename_'))
+            mdfname=obj.metadatafilename(parent)
+            # an empty branch has no metadata file
+            obj.__mdmemory__=nsd_loadmetadatafile(mdfname) if os.path.isfile(mdfname) else []
+            obj.__leaf__=nsd_leafstore(obj.__leaf__.compact,obj.readleaves([row.get('_objectfilename_') for row in obj.__mdmemory__],usethispath=parent,cache=0))
+            obj.__saveddir__=parent
+        return obj
     
-    def lock(self,thedirname=''):
-       ''' LOCK - lock the metadata file and object files so other processes cannot change them
+    def lock(self,thedirname='',exclusive=1,timeout=None):
+        ''' LOCK - lock the metadata file and object files so other processes cannot change them
         Attempts to obtain the lock on the metadata file nad object files. If it is successful,
         B is 1. Otherwise, B is 0.
         THEDIRNAME is the directory where the lock file resides. If it is not provided, then 
-        NSD_DBLEAF_BRANCH_OBJ.path is used.'''
-       b=0
-       if not thedirname:
-           thedirname=self._path_
-       if int(self._memory_):
-           number_of_tries = 30
-           mytry = 0
-           while self.__lockfid__ and mytry<number_of_tries:
-               time.sleep(1)
-               mytry+=1
-           if not self.__lockfid__:
-               self.__lockfid__='locked'
-               b=1
-       else:
-           b=super(nsd_dbleaf_branch,self).lock(thedirname)
-       return b
+        NSD_DBLEAF_BRANCH_OBJ.path is used. EXCLUSIVE and TIMEOUT are as for NSD_BASE/LOCK.
+        A branch that is in memory only (or has no path) is locked within this process only.'''
+        if not thedirname:
+            thedirname=self._path_
+        if int(self._memory_) or not thedirname:
+            lockfid=self.__lockfid__.setdefault(None,nsd_lockfile(None))
+            return lockfid.acquire(exclusive,timeout)
+        return super(nsd_dbleaf_branch,self).lock(thedirname,exclusive,timeout)
     
     def unlock(self,thedirname=''):
         '''UNLOCK - unlock the metadata file and object files so other processes can change them
-        Removes the lock file from the NSD_DBLEAF_BRANCH NSD_DBLEAF_BRANCH_OBJ.'''
-        b=1
+        Releases the lock of the NSD_DBLEAF_BRANCH NSD_DBLEAF_BRANCH_OBJ.'''
         if not thedirname:
-           thedirname=self._path_
-        if self.__lockfid__:
-            if self.__mdmemory__:
-                self.__lockfid__=[]
-            else:
-                b=super(nsd_dbleaf_branch,self).unlock(thedirname)
-        return b
+            thedirname=self._path_
+        if int(self._memory_) or not thedirname:
+            lockfid=self.__lockfid__.get(None)
+            return lockfid.release() if lockfid else 1
+        return super(nsd_dbleaf_branch,self).unlock(thedirname)
+
+    def lockholder(self,thedirname=''):
+        '''LOCKHOLDER - describe who holds the lock of the NSD_DBLEAF_BRANCH, for error messages'''
+        if not thedirname:
+            thedirname=self._path_
+        if int(self._memory_) or not thedirname:
+            return 'The branch '+self._name_+' is in use by another thread.'
+        return super(nsd_dbleaf_branch,self).lockholder(thedirname)
     
     def metadatafilename(self,usethispath=''):
         '''FILENAME - Return the (full path) metadata database file name associated with an NSD_DBLEAF_BRANCH
@@ -379,6 +1310,16 @@ class nsd_dbleaf_branch(nsd_dbleaf):
             usethispath=self._path_
         fname=usethispath+'/'+self._objectfilename_+'.metadata.dbleaf_branch.nsd'
         return fname
+
+    def journalfilename(self,usethispath=''):
+        '''JOURNALFILENAME - Return the (full path) metadata journal file name associated with an NSD_DBLEAF_BRANCH
+        Returns the filename of the journal of metadata changes that have not yet been
+        compacted into the metadata file (full path).'''
+        return self.metadatafilename(usethispath)+'.journal'
+
+    def generationfilename(self,usethispath=''):
+        '''GENERATIONFILENAME - Return the (full path) name of the file that holds the metadata generation counter'''
+        return self.metadatafilename(usethispath)+'.generation'
     
     def dirname(self,usethispath=''):
         ''' DIRNAME - Return the (full path) database directory name where objects are stored
@@ -388,10 +1329,63 @@ class nsd_dbleaf_branch(nsd_dbleaf):
         elif not usethispath:
             return ''
         dname=usethispath+'/'+self._objectfilename_+'.subdir.dbleaf_branch.nsd'
-        if not os.path.isdir(dname):
-            os.mkdir(dname)
+        if dname not in self.__dirnames__:
+            if not os.path.isdir(dname):
+                os.makedirs(dname,exist_ok=True)
+            self.__dirnames__.add(dname)
         return dname
     
+    def leafdir(self,objectfilename,usethispath=''):
+        '''LEAFDIR - Return the (full path) directory where the object file OBJECTFILENAME is stored
+        This is DIRNAME, or, if LAYOUT is 1, the subdirectory of DIRNAME named by two hex
+        digits of a hash of OBJECTFILENAME. The directory is created if needed.'''
+        dname=self.dirname(usethispath)
+        if not int(self._layout_) or not dname:
+            return dname
+        dname=dname+'/'+nsd_shardname(objectfilename)
+        if dname not in self.__dirnames__:
+            if not os.path.isdir(dname):
+                os.makedirs(dname,exist_ok=True)
+            self.__dirnames__.add(dname)
+        return dname
+
+    def leaffilename(self,objectfilename,usethispath=''):
+        '''LEAFFILENAME - Return the (full path) file name of the object file OBJECTFILENAME of the branch'''
+        return self.leafdir(objectfilename,usethispath)+'/'+objectfilename
+
+    def migratelayout(self,layout=1):
+        '''MIGRATELAYOUT - Change the LAYOUT of the subdirectory of an NSD_DBLEAF_BRANCH
+        Moves every object file (with the files of sub-branches) of the branch to where LAYOUT
+        puts it, and saves LAYOUT in the object file of the branch. Files are renamed, not
+        copied. If a migration is interrupted, calling MIGRATELAYOUT again completes it; until
+        then, objects that have not been moved yet cannot be loaded. Other processes should not
+        use the branch during the migration.'''
+        with self.locked():
+            self._layout_=layout
+            if self.inmemory():
+                self.__saveddir__=None # the next FLUSH writes everything in the new layout
+                return
+            dname=self.dirname()
+            for shard in [None]+[e.name for e in os.scandir(dname) if e.is_dir() and len(e.name)==2]:
+                source=dname if shard is None else dname+'/'+shard
+                for entry in os.scandir(source):
+                    if shard is None and entry.is_dir() and len(entry.name)==2:
+                        continue
+                    objectfilename=entry.name.split('.',1)[0]
+                    if objectfilename.endswith('-lock'):
+                        continue
+                    target=self.leafdir(objectfilename)
+                    if target!=source:
+                        os.rename(entry.path,target+'/'+entry.name)
+                if shard is not None and not int(layout):
+                    try:
+                        os.rmdir(source)
+                    except OSError:
+                        pass
+            self.__dirnames__.clear()
+            nsd_leafcache.invalidate() # cached sub-branches know their old paths
+            self.writeownobjectfile(self._path_)
+
     def deleteobjectfile(self,thedirname=''):
         ''' DELETEOBJECTFILE - Delete / remove the object file (or files) for NSD_DBLEAF_BRANCH
          Delete all files associated with NSD_DBLEAF_BRANCH_OBJ in directory THEDIRNAME (full path).'''
@@ -404,6 +1398,1553 @@ class nsd_dbleaf_branch(nsd_dbleaf):
             os.remove(self.metadatafilename())
         except:
             b=0
+        for fname in (self.journalfilename(thedirname),self.generationfilename(thedirname),self.segmentfilename(thedirname),self.subtreefilename(thedirname)):
+            if os.path.isfile(fname):
+                os.remove(fname)
         shutil.rmtree(self.dirname(thedirname))
+        self.__dirnames__.clear()
         b=super(nsd_dbleaf_branch,self).deleteobjectfile(thedirname)
         return b
+
+
+class nsd_async_branch:
+    '''NSD_ASYNC_BRANCH - An asyncio interface to an NSD_DBLEAF_BRANCH
+
+    ABRANCH = NSD_ASYNC_BRANCH(BRANCH, [MAXCONCURRENT], [READERS])
+
+    Offers awaitable versions of the operations of the NSD_DBLEAF_BRANCH BRANCH, so that an
+    event loop is not stalled by their file I/O or by waiting for the lock:
+
+        await ABRANCH.ADD(OBJ)
+        OBJS = await ABRANCH.LOAD('_name_', 'trial.*')
+
+    Operations that change the branch (ADD, ADD_MANY, UPDATE, REMOVE, WRITEOBJECTFILE) run in
+    one writer thread per NSD_ASYNC_BRANCH, as the lock of a branch belongs to the thread that
+    took it. The lock is tried without waiting; while another thread or process holds it,
+    the coroutine sleeps, from LOCKDELAY seconds doubling up to MAXLOCKDELAY, rather than
+    blocking, and raises an exception after LOCKTIMEOUT seconds (NSD_LOCKTIMEOUT if None).
+    SEARCH, LOAD and NUMITEMS of a branch on disk run in a pool of READERS threads, each of
+    which reads through its own copy of the branch (see NSD_DBLEAF_BRANCH/READER), so that they
+    never see the caches of BRANCH while the writer thread is changing them; they take no lock
+    (see NSD_DBLEAF_BRANCH/READSNAPSHOT). Those of a branch in memory run in the writer thread,
+    after the changes before them. At most MAXCONCURRENT operations of the branch run at once; the
+    others wait their turn in the event loop.
+    A cancelled operation that has already started in a thread still completes there.
+    Call CLOSE when done, to stop the threads.'''
+    def __init__(self, branch, maxconcurrent=8, readers=4, lockdelay=0.001, maxlockdelay=0.05, locktimeout=None):
+        self.branch=branch
+        self.maxconcurrent=maxconcurrent
+        self.lockdelay=lockdelay
+        self.maxlockdelay=maxlockdelay
+        self.locktimeout=locktimeout
+        self.writer=concurrent.futures.ThreadPoolExecutor(1,thread_name_prefix='nsd_async_branch writer')
+        self.readers=concurrent.futures.ThreadPoolExecutor(readers,thread_name_prefix='nsd_async_branch reader')
+        self.semaphore=None # made in the event loop by the first operation
+        self.local=threading.local() # the copy of the branch of each reader thread, see READER
+
+    def limit(self):
+        '''LIMIT - The semaphore that bounds the number of operations running at once'''
+        if self.semaphore is None:
+            self.semaphore=asyncio.Semaphore(self.maxconcurrent)
+        return self.semaphore
+
+    async def read(self, method, *args):
+        '''READ - Call the NSD_DBLEAF_BRANCH method METHOD (a name) with ARGS and return its result
+        See NSD_ASYNC_BRANCH for which thread reads.'''
+        loop=asyncio.get_running_loop()
+        async with self.limit():
+            if self.branch.inmemory():
+                return await loop.run_in_executor(self.writer,functools.partial(getattr(self.branch,method),*args))
+            return await loop.run_in_executor(self.readers,self.readwith,method,args)
+
+    def readwith(self, method, args):
+        '''READWITH - In a reader thread, call METHOD(*ARGS) on the copy of the branch of the thread'''
+        branch=getattr(self.local,'branch',None)
+        if branch is None:
+            branch=self.local.branch=self.branch.reader()
+        return getattr(branch,method)(*args)
+
+    async def write(self, f, *args):
+        '''WRITE - Call F(*ARGS) in the writer thread while holding the lock of the branch
+        Returns the result of F. See NSD_ASYNC_BRANCH for how the lock is waited for.'''
+        loop=asyncio.get_running_loop()
+        timeout=nsd_locktimeout if self.locktimeout is None else self.locktimeout
+        t0=loop.time()
+        delay=self.lockdelay
+        async with self.limit():
+            while True:
+                [b,result]=await loop.run_in_executor(self.writer,self.trywrite,f,args)
+                if b:
+                    if nsd_stats.enabled:
+                        nsd_stats.record('asynclockwait',loop.time()-t0)
+                    return result
+                if loop.time()-t0>=timeout:
+                    if nsd_stats.enabled:
+                        nsd_stats.recordlockwait(loop.time()-t0,0)
+                    raise Exception('Could not obtain the lock of the branch '+self.branch._name_+'. '+self.branch.lockholder())
+                await asyncio.sleep(delay)
+                delay=min(2*delay,self.maxlockdelay)
+
+    def trywrite(self, f, args):
+        '''TRYWRITE - In the writer thread, call F(*ARGS) if the lock can be had at once
+        Returns [1, RESULT] if F was called, and [0, None] if the lock is held by someone else.
+        Taking the lock and calling F are one job, so the lock is released even if the
+        coroutine that waits for the job is cancelled.'''
+        if not self.branch.lock('',1,0):
+            return [0,None]
+        try:
+            return [1,f(*args)]
+        finally:
+            self.branch.unlock()
+
+    async def add(self, newobj):
+        '''ADD - Add the item NEWOBJ to the branch (see NSD_DBLEAF_BRANCH/ADD)'''
+        return await self.write(self.branch.add_many,[newobj])
+
+    async def add_many(self, newobjs):
+        '''ADD_MANY - Add the items in the list NEWOBJS to the branch (see NSD_DBLEAF_BRANCH/ADD_MANY)'''
+        return await self.write(self.branch.add_many,list(newobjs))
+
+    async def update(self, nsd_dbleaf_obj):
+        '''UPDATE - Store the changed object NSD_DBLEAF_OBJ (see NSD_DBLEAF_BRANCH/UPDATE)'''
+        return await self.write(self.branch.update,nsd_dbleaf_obj)
+
+    async def remove(self, objectfilename):
+        '''REMOVE - Remove the item OBJECTFILENAME from the branch (see NSD_DBLEAF_BRANCH/REMOVE)'''
+        return await self.write(self.branch.remove,objectfilename)
+
+    async def writeobjectfile(self, thedirname=[]):
+        '''WRITEOBJECTFILE - Write the branch to THEDIRNAME (see NSD_DBLEAF_BRANCH/WRITEOBJECTFILE)
+        A branch in memory is written by FLUSH, which must take the flush lock before the lock
+        of the branch; so it is called in the writer thread without taking the lock first, and
+        that thread waits for the locks as FLUSH does.'''
+        if self.branch.inmemory():
+            loop=asyncio.get_running_loop()
+            async with self.limit():
+                return await loop.run_in_executor(self.writer,self.branch.writeobjectfile,thedirname)
+        return await self.write(self.branch.writeobjectfile,thedirname)
+
+    async def search(self, *varargin):
+        '''SEARCH - Return [INDEXES, MD] of the entries that match (see NSD_DBLEAF_BRANCH/SEARCH)'''
+        return await self.read('search',*varargin)
+
+    async def load(self, *varargin):
+        '''LOAD - Return the objects at INDEXES, or that match a search (see NSD_DBLEAF_BRANCH/LOAD)'''
+        return await self.read('load',*varargin)
+
+    async def numitems(self):
+        '''NUMITEMS - Return the number of items in the branch (see NSD_DBLEAF_BRANCH/NUMITEMS)'''
+        return await self.read('numitems')
+
+    async def close(self):
+        '''CLOSE - Wait for the running operations to finish and stop the threads'''
+        loop=asyncio.get_running_loop()
+        await loop.run_in_executor(None,self.writer.shutdown)
+        await loop.run_in_executor(None,self.readers.shutdown)
+
+
+def nsd_shardname(objectfilename):
+    '''NSD_SHARDNAME - Name of the hash-prefix subdirectory of an object file (LAYOUT 1)
+    Two hex digits of the CRC-32 of OBJECTFILENAME, spreading files over 256 directories.'''
+    return '%02x' % (zlib.crc32(objectfilename.encode('utf-8')) & 0xff)
+
+
+def nsd_indexkey(value):
+    '''NSD_INDEXKEY - Return a hashable key for a metadata value
+    Values that cannot be hashed (lists, arrays) are indexed by their string form.'''
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return str(value)
+
+
+
+
+class nsd_objectcache:
+    '''NSD_OBJECTCACHE - A bounded, least-recently-used cache of objects read from object files
+
+    Objects are keyed by the full path of their object file and are only returned while
+    the file is unchanged (same modification time, size and inode; files are replaced
+    atomically when they are written, so every write changes the inode). The cache keeps
+    its own copy of each object and hands out a new copy (see NSD_COPYLEAF) on every hit,
+    so a change to a loaded object is never seen by other callers until it is saved.
+    Branches are not cached: they share their caches and locks with whoever holds them.
+    The cache holds at most MAXENTRIES objects and at most MAXBYTES bytes of object files;
+    0 means no limit for one of them, and 0 for both turns the cache off. HITS and MISSES
+    count lookups.'''
+    def __init__(self, maxentries=4096, maxbytes=64*2**20, reader=None):
+        '''NSD_OBJECTCACHE - Create a cache; READER(FILENAME) reads an object (default: NSD_PICKDBLEAF)'''
+        self.maxentries=maxentries
+        self.maxbytes=maxbytes
+        self.reader=reader
+        self.entries=collections.OrderedDict() # filename -> [stamp, object, size]
+        self.nbytes=0
+        self.hits=0
+        self.misses=0
+        self.mutex=threading.Lock()
+
+    def get(self, filename, stamp=None, size=0, read=None):
+        '''GET - Return the object in FILENAME, reading it only if it is not cached or has changed
+        An object that does not have a file of its own (see NSD_LEAFSEGMENT) is given with the
+        STAMP of its version and its SIZE in bytes instead, and is read by calling READ().'''
+        if stamp is None:
+            st=os.stat(filename)
+            stamp=(st.st_mtime_ns,st.st_size,st.st_ino)
+            size=st.st_size
+        with self.mutex:
+            entry=self.entries.get(filename)
+            if entry is not None and entry[0]==stamp:
+                self.entries.move_to_end(filename)
+                self.hits+=1
+                obj=entry[1]
+            else:
+                obj=None
+                self.misses+=1
+        if obj is not None:
+            return nsd_copyleaf(obj)
+        if read is not None:
+            obj=read()
+        else:
+            reader=self.reader or nsd_pickdbleaf
+            obj=reader(filename)
+        self.store(filename,stamp,obj,size)
+        return obj
+
+    def put(self, filename, obj):
+        '''PUT - Cache OBJ as the contents of FILENAME, which it was just written to'''
+        try:
+            st=os.stat(filename)
+        except OSError:
+            self.invalidate(filename)
+            return
+        self.store(filename,(st.st_mtime_ns,st.st_size,st.st_ino),obj,st.st_size)
+
+    def store(self, filename, stamp, obj, size):
+        '''STORE - Add a copy of OBJ and evict the least recently used entries beyond the limits
+        A branch is not stored; any entry of FILENAME is forgotten instead.'''
+        if not self.maxentries and not self.maxbytes:
+            return
+        if isinstance(obj,nsd_dbleaf_branch):
+            self.invalidate(filename)
+            return
+        obj=nsd_copyleaf(obj)
+        with self.mutex:
+            old=self.entries.pop(filename,None)
+            if old is not None:
+                self.nbytes-=old[2]
+            self.entries[filename]=[stamp,obj,size]
+            self.nbytes+=size
+            while self.entries and ((self.maxentries and len(self.entries)>self.maxentries) or (self.maxbytes and self.nbytes>self.maxbytes)):
+                filename,entry=self.entries.popitem(last=False)
+                self.nbytes-=entry[2]
+
+    def peek(self, filename):
+        '''PEEK - Return the cached object of FILENAME if the file is unchanged, or None
+        A hit counts as one; a miss is not counted, as the caller will read the file.'''
+        with self.mutex:
+            entry=self.entries.get(filename)
+        if entry is None:
+            return None
+        try:
+            st=os.stat(filename)
+        except OSError:
+            return None
+        with self.mutex:
+            if entry[0]!=(st.st_mtime_ns,st.st_size,st.st_ino) or self.entries.get(filename) is not entry:
+                return None
+            self.entries.move_to_end(filename)
+            self.hits+=1
+        return nsd_copyleaf(entry[1])
+
+    def invalidate(self, filename=None):
+        '''INVALIDATE - Forget the object in FILENAME, or every object if FILENAME is None'''
+        with self.mutex:
+            if filename is None:
+                self.entries.clear()
+                self.nbytes=0
+            else:
+                entry=self.entries.pop(filename,None)
+                if entry is not None:
+                    self.nbytes-=entry[2]
+
+    def resize(self, maxentries, maxbytes):
+        '''RESIZE - Change the limits of the cache, evicting entries as needed'''
+        with self.mutex:
+            self.maxentries=maxentries
+            self.maxbytes=maxbytes
+        if not maxentries and not maxbytes:
+            self.invalidate()
+        else:
+            with self.mutex:
+                while self.entries and ((maxentries and len(self.entries)>maxentries) or (maxbytes and self.nbytes>maxbytes)):
+                    filename,entry=self.entries.popitem(last=False)
+                    self.nbytes-=entry[2]
+
+    def stats(self):
+        '''STATS - Return a dictionary with the number of entries, bytes, hits and misses'''
+        with self.mutex:
+            return {'entries':len(self.entries),'bytes':self.nbytes,'hits':self.hits,'misses':self.misses}
+
+
+nsd_leafcache=nsd_objectcache() # cache of the objects loaded by NSD_DBLEAF_BRANCH/LOAD
+
+
+def nsd_copyleaf(obj):
+    '''NSD_COPYLEAF - Return a copy of OBJ that shares no mutable values with it
+    The copy holds none of the locks of OBJ (see NSD_BASE/LOCK).'''
+    memo={}
+    lockfid=vars(obj).get('__lockfid__')
+    if lockfid is not None:
+        memo[id(lockfid)]={}
+    return copy.deepcopy(obj,memo)
+
+
+def nsd_readleaffile(filename):
+    '''NSD_READLEAFFILE - Read the object in FILENAME in a worker process
+    [STAMP, SIZE, OBJ] = NSD_READLEAFFILE(FILENAME)
+    STAMP and SIZE describe the file as it was before it was read, for NSD_OBJECTCACHE/STORE.'''
+    st=os.stat(filename)
+    return [(st.st_mtime_ns,st.st_size,st.st_ino),st.st_size,nsd_pickdbleaf(filename)]
+
+
+def nsd_readleaves(filenames, workers=0, processes=0):
+    '''NSD_READLEAVES - Generator of the objects in the files FILENAMES, in order
+    Objects are read through NSD_LEAFCACHE. If WORKERS > 1 the files are read by a pool of
+    threads (or of processes, if PROCESSES is 1) that stays at most 2*WORKERS files ahead.
+    Processes can only be used if this module can be imported by name in a new process, not
+    when the database files were executed into a namespace of their own.'''
+    if workers<=1:
+        for f in filenames:
+            yield nsd_leafcache.get(f)
+        return
+    if processes:
+        try:
+            pickle.loads(pickle.dumps(nsd_readleaffile))
+        except Exception as e:
+            raise Exception('Objects cannot be read by processes: the module of NSD_READLEAFFILE cannot be imported by name ('+str(e)+'); use threads (PROCESSES 0).')
+        pool=concurrent.futures.ProcessPoolExecutor(workers)
+    else:
+        pool=concurrent.futures.ThreadPoolExecutor(workers)
+    pending=collections.deque()
+    def result(f,future):
+        if not processes:
+            return future.result()
+        if isinstance(future,concurrent.futures.Future):
+            stamp,size,obj=future.result()
+            nsd_leafcache.store(f,stamp,obj,size)
+            return obj
+        return future
+    finished=0
+    try:
+        for f in filenames:
+            if processes:
+                obj=nsd_leafcache.peek(f)
+                if obj is None:
+                    nsd_leafcache.misses+=1
+                    obj=pool.submit(nsd_readleaffile,f)
+                pending.append((f,obj))
+            else:
+                pending.append((f,pool.submit(nsd_leafcache.get,f)))
+            if len(pending)>=2*workers:
+                yield result(*pending.popleft())
+        while pending:
+            yield result(*pending.popleft())
+        finished=1
+    finally:
+        # after an error (or if the caller stopped early) do not wait for the workers
+        pool.shutdown(wait=bool(finished),cancel_futures=True)
+
+
+nsd_leafsegment_magic=b'NSDSEG\x00\x00'
+nsd_leafsegment_version=1
+nsd_leafsegment_header=struct.Struct('<8sIQ') # magic, version, token that identifies this copy of the file
+nsd_leafsegment_record=struct.Struct('<cxHII') # kind, name length, text length, CRC-32 of the name and text
+
+
+class nsd_leafsegment:
+    '''NSD_LEAFSEGMENT - A file that holds the object files of many objects of a PACKED branch
+
+    The objects are appended to the file as records: a header with the kind of record,
+    the lengths of the name and of the text and a checksum, followed by the object file
+    name and the text of the object file (see NSD_BASE/WRITEOBJECTFILE). A record of kind
+    'L' stores an object, replacing any earlier record with the same name; a record of kind
+    'D' marks the object as removed. The file is memory-mapped, and INDEX maps each object
+    file name to where its latest text is, so that an object is read with one slice of
+    the map. The index is built by reading the record headers, and only the records
+    appended since are read when the file grows. A record that was only partly written is
+    ignored, and cut off by the next APPEND.
+    Replaced and removed records stay in the file until COMPACT copies the live records to
+    a new file. The new file gets a new TOKEN, so entries cached from the old file (whose
+    stamp is [TOKEN, OFFSET], see LOCATE) are not mistaken for entries of the new one.
+    Writers (APPEND, COMPACT) must hold the lock of the branch; readers need no lock.'''
+    compactbytes=2**20 # GARBAGE needs at least this many bytes of dead records
+
+    def __init__(self, filename):
+        self.filename=filename
+        self.mutex=threading.RLock()
+        self.reset()
+
+    def reset(self):
+        '''RESET - Forget the file'''
+        self.buf=None # memory map of the file
+        self.ino=None # inode of the mapped file
+        self.token=None
+        self.size=0 # size of the file when it was last looked at
+        self.end=0 # end of the last complete record
+        self.index={} # object file name -> (text offset, text length, CRC-32, record size)
+        self.dead=0 # bytes of records that were replaced or removed
+
+    def __len__(self):
+        return len(self.index)
+
+    def refresh(self):
+        '''REFRESH - Bring the map and the index up to date with the file, and return the segment'''
+        with self.mutex:
+            try:
+                fid=open(self.filename,'rb')
+            except FileNotFoundError:
+                self.reset()
+                return self
+            with fid:
+                st=os.fstat(fid.fileno())
+                if st.st_ino!=self.ino:
+                    self.reset()
+                elif st.st_size==self.size:
+                    return self
+                self.size=st.st_size
+                if st.st_size<nsd_leafsegment_header.size:
+                    return self # still being created
+                self.buf=mmap.mmap(fid.fileno(),0,access=mmap.ACCESS_READ)
+            if self.ino is None:
+                magic,version,self.token=nsd_leafsegment_header.unpack_from(self.buf,0)
+                if magic!=nsd_leafsegment_magic:
+                    raise Exception('Not a leaf segment file: '+self.filename)
+                if version>nsd_leafsegment_version:
+                    raise Exception('Leaf segment file '+self.filename+' has version '+str(version)+', which is newer than this code can read.')
+                self.ino=st.st_ino
+                self.end=nsd_leafsegment_header.size
+            self.scan()
+        return self
+
+    def scan(self):
+        '''SCAN - Add the records after END to the index'''
+        buf=self.buf
+        n=len(buf)
+        pos=self.end
+        while pos+nsd_leafsegment_record.size<=n:
+            kind,namelen,textlen,crc=nsd_leafsegment_record.unpack_from(buf,pos)
+            start=pos+nsd_leafsegment_record.size
+            stop=start+namelen+textlen
+            if kind not in (b'L',b'D') or stop>n:
+                break # partly written
+            name=bytes(buf[start:start+namelen]).decode('utf-8')
+            old=self.index.pop(name,None)
+            if old is not None:
+                self.dead+=old[3]
+            if kind==b'L':
+                self.index[name]=(start+namelen,textlen,crc,stop-pos)
+            else:
+                self.dead+=stop-pos
+            pos=stop
+        self.end=pos
+
+    def locate(self, name):
+        '''LOCATE - Return [STAMP, SIZE] of the object NAME, or None if it is not in the segment
+        STAMP identifies this version of the object, for NSD_OBJECTCACHE.'''
+        with self.mutex:
+            entry=self.index.get(name)
+            if entry is None:
+                return None
+            return [(self.token,entry[0]),entry[1]]
+
+    def read(self, name):
+        '''READ - Return the text (bytes) of the object NAME'''
+        with self.mutex:
+            entry=self.index.get(name)
+            if entry is None:
+                raise Exception('No object '+name+' in leaf segment '+self.filename+'.')
+            offset,length,crc,size=entry
+            text=self.buf[offset:offset+length]
+        if zlib.crc32(text,zlib.crc32(name.encode('utf-8')))!=crc:
+            raise Exception('The object '+name+' in leaf segment '+self.filename+' is corrupt.')
+        if nsd_stats.enabled:
+            nsd_stats.record('readsegment',bytesread=length)
+        return text
+
+    def prefetch(self, names):
+        '''PREFETCH - Ask the system to read the records of the objects NAMES ahead
+        The records are taken in file order and runs of nearby records are requested
+        together, so that reading many objects turns into a few large sequential reads.'''
+        if not hasattr(mmap,'MADV_WILLNEED'):
+            return
+        with self.mutex:
+            if self.buf is None:
+                return
+            spans=sorted((e[0]+e[1]-e[3],e[0]+e[1]) for e in map(self.index.get,names) if e is not None)
+            runs=[]
+            for start,stop in spans:
+                if runs and start-runs[-1][1]<=2**16:
+                    runs[-1][1]=max(runs[-1][1],stop)
+                else:
+                    runs.append([start,stop])
+            for start,stop in runs:
+                start-=start%mmap.PAGESIZE
+                self.buf.madvise(mmap.MADV_WILLNEED,start,stop-start)
+
+    @nsd_instrumented('appendsegment')
+    def append(self, records):
+        '''APPEND - Append RECORDS, a list of [NAME, TEXT] pairs, to the segment in one write
+        TEXT is the bytes of the object file of the object NAME, or None to remove the object.
+        The file is created if needed. The caller must hold the lock of the branch, or, for a
+        branch in memory, its flush lock (see NSD_DBLEAF_BRANCH/COMPACTSEGMENT).'''
+        data=[]
+        for name,text in records:
+            name=name.encode('utf-8')
+            kind=b'D' if text is None else b'L'
+            text=text or b''
+            data.append(nsd_leafsegment_record.pack(kind,len(name),len(text),zlib.crc32(text,zlib.crc32(name)))+name+text)
+        data=b''.join(data)
+        with self.mutex:
+            self.refresh()
+            if self.ino is None:
+                with nsd_atomicfile(self.filename,'wb') as fid:
+                    fid.write(nsd_leafsegment_header.pack(nsd_leafsegment_magic,nsd_leafsegment_version,nsd_segmenttoken()))
+                self.refresh()
+            elif self.size>self.end:
+                os.truncate(self.filename,self.end) # a record left over from an interrupted APPEND
+            with open(self.filename,'ab') as fid:
+                fid.write(data)
+                fid.flush()
+                os.fsync(fid.fileno())
+            if nsd_stats.enabled:
+                nsd_stats.record('appendsegment',byteswritten=len(data),calls=0)
+            self.refresh()
+
+    def garbage(self):
+        '''GARBAGE - Is the segment worth compacting?
+        True if at least half of the file, and at least COMPACTBYTES, is dead records.'''
+        with self.mutex:
+            return self.dead>=self.compactbytes and 2*self.dead>=self.end
+
+    @nsd_instrumented('compactsegment')
+    def compact(self, locked):
+        '''COMPACT - Rewrite the segment with only its live records
+        The live records are copied to a new file without holding the lock; then, within
+        the WITH block of the context manager LOCKED(), the records that were appended in
+        the meantime are copied as they are and the new file replaces the old one. Readers
+        that still have the old file mapped keep a consistent copy. Returns the number of
+        bytes that were dropped.'''
+        self.refresh()
+        with self.mutex:
+            if self.buf is None:
+                return 0
+            buf,ino,end,dead=self.buf,self.ino,self.end,self.dead
+            live=sorted(self.index.values())
+        tmpname=nsd_tempfilename(self.filename)
+        fid=open(tmpname,'wb')
+        try:
+            try:
+                fid.write(nsd_leafsegment_header.pack(nsd_leafsegment_magic,nsd_leafsegment_version,nsd_segmenttoken()))
+                for offset,length,crc,size in live:
+                    fid.write(buf[offset+length-size:offset+length])
+                with locked():
+                    self.refresh()
+                    with self.mutex:
+                        if self.ino!=ino:
+                            return 0 # compacted by someone else meanwhile
+                        fid.write(self.buf[end:self.end])
+                    fid.flush()
+                    os.fsync(fid.fileno())
+                    fid.close()
+                    nsd_replacefile(tmpname,self.filename,0)
+                    self.refresh()
+            finally:
+                fid.close()
+        finally:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+        return dead
+
+
+nsd_leafsegments={} # file name -> NSD_LEAFSEGMENT, shared by all branches of this process
+nsd_leafsegmentsmutex=threading.Lock()
+
+
+def nsd_openleafsegment(filename):
+    '''NSD_OPENLEAFSEGMENT - Return the NSD_LEAFSEGMENT of the file FILENAME (which need not exist yet)'''
+    with nsd_leafsegmentsmutex:
+        segment=nsd_leafsegments.get(filename)
+        if segment is None:
+            segment=nsd_leafsegments[filename]=nsd_leafsegment(filename)
+        return segment
+
+
+def nsd_segmenttoken():
+    '''NSD_SEGMENTTOKEN - A random number that identifies one copy of a segment file'''
+    return int.from_bytes(os.urandom(8),'little')
+
+
+def nsd_packable(obj):
+    '''NSD_PACKABLE - Can OBJ be stored in the segment of a PACKED branch?
+    Only objects whose whole state is in their object file can: branches, and classes that
+    write, read or delete their object files in their own way, keep their own files.'''
+    cls=obj.__class__ # the class of the object an NSD_LEAFPROXY stands for
+    return not isinstance(obj,nsd_dbleaf_branch) and cls.writeobjectfile is nsd_dbleaf.writeobjectfile and \
+        cls.readobjectfile is nsd_dbleaf.readobjectfile and cls.deleteobjectfile is nsd_dbleaf.deleteobjectfile
+
+
+def nsd_objecttext(obj):
+    '''NSD_OBJECTTEXT - The text (bytes) of the object file of OBJ, as NSD_BASE/WRITEOBJECTFILE writes it'''
+    if isinstance(obj,nsd_leafproxy):
+        if obj.leafobj is None:
+            return obj.leaftext+b'\n'
+        obj=obj.leafobj # it may have been changed since
+    data,fieldnames=obj.stringdatatosave()
+    return ''.join(d+'\n' for d in data).encode('utf-8')
+
+
+def nsd_leaffromtext(text, filename=''):
+    '''NSD_LEAFFROMTEXT - Create an object from the text (bytes) of its object file
+    The first line of TEXT names the class of the object; FILENAME is given to the object
+    as the name of the file it was read from.'''
+    classname=text.split(b'\n',1)[0].decode('utf-8')
+    cls=globals().get(classname)
+    if not isinstance(cls,type) or not issubclass(cls,nsd_base):
+        raise Exception('Unknown class '+classname+' of the object '+filename+'.')
+    fid=io.StringIO(text.decode('utf-8'))
+    fid.name=filename
+    return cls(fid,'OpenFile')
+
+
+def nsd_mergemetadata(md, rows):
+    '''NSD_MERGEMETADATA - Append metadata entries, reconciling their fields
+    [MD, CHANGED] = NSD_MERGEMETADATA(MD, ROWS)
+    Appends the metadata structures in the list ROWS to the list MD. If the entries
+    do not all have the same fields, every entry is padded with '' for the fields it
+    lacks, so that the result has a single set of fields. Existing entries are replaced
+    rather than modified in place. CHANGED is 1 if existing entries had to be padded
+    (or MD was empty), and 0 otherwise. If MD is an NSD_METADATACOLUMNS object, the
+    entries are appended to it in place.'''
+    if isinstance(md,nsd_metadatacolumns):
+        return md,md.extend(rows)
+    md=[row for row in md if row]
+    fields=dict.fromkeys(md[0]) if md else {}
+    nold=len(fields)
+    for row in rows:
+        for f in row:
+            fields.setdefault(f)
+    changed=int(not md or len(fields)!=nold)
+    if changed:
+        md=[{**row, **{f:'' for f in fields if f not in row}} for row in md]
+    for row in rows:
+        if len(row)!=len(fields):
+            row={**row, **{f:'' for f in fields if f not in row}}
+        md.append(row)
+    return md,changed
+
+
+def nsd_journalbase(fname):
+    '''NSD_JOURNALBASE - Return the metadata file stamp a metadata journal was started against
+    The first line of a journal records the [MTIME, SIZE] of the metadata file it applies
+    to. Returns None if the journal cannot be read.'''
+    try:
+        with open(fname,'r') as fid:
+            return json.loads(fid.readline()).get('base')
+    except (OSError, ValueError):
+        return None
+
+
+def nsd_replayjournal(md, fname, basestamp):
+    '''NSD_REPLAYJOURNAL - Apply the changes recorded in a metadata journal
+    MD = NSD_REPLAYJOURNAL(MD, FNAME, BASESTAMP)
+    Replays the records of the journal FNAME on top of the metadata MD that was read from
+    a metadata file with stamp BASESTAMP (MTIME, SIZE). A journal that was started against
+    a different metadata file (left over from an interrupted compaction) is ignored, as
+    is a final record that was only partly written.'''
+    try:
+        with open(fname,'r') as fid:
+            lines=fid.read().split('\n')[:-1]
+    except OSError:
+        return md
+    if not lines or json.loads(lines[0]).get('base')!=list(basestamp):
+        return md
+    for line in lines[1:]:
+        record=json.loads(line)
+        if 'add' in record:
+            md,changed=nsd_mergemetadata(md,record['add'])
+        elif 'update' in record:
+            md=md.copy() if isinstance(md,nsd_metadatacolumns) else list(md)
+            for i,row in record['update'].items():
+                md[int(i)]=row
+        elif 'remove' in record:
+            removed=set(record['remove'])
+            tokeep=[i for i in range(len(md)) if i not in removed]
+            if isinstance(md,nsd_metadatacolumns):
+                md=md.take(tokeep)
+            else:
+                md=[md[i] for i in tokeep]
+    return md
+
+
+def nsd_jsonvalue(value):
+    '''NSD_JSONVALUE - Convert a metadata value that JSON does not know about'''
+    if isinstance(value,np.generic):
+        return value.item()
+    if isinstance(value,np.ndarray):
+        return value.tolist()
+    return str(value)
+
+class nsd_searchrange:
+    '''NSD_SEARCHRANGE - A numeric range to search for in NSD_DBLEAF_BRANCH metadata'''
+    def __init__(self, low=None, high=None):
+        '''NSD_SEARCHRANGE - Create a range search term
+        R = NSD_SEARCHRANGE(LOW, HIGH)
+        Matches metadata values V with LOW <= V <= HIGH. Either bound may be None
+        to leave that side open. Values that are not numbers do not match.'''
+        self.low=low
+        self.high=high
+
+    def matches(self, value):
+        '''MATCHES - Does VALUE fall within the range?'''
+        try:
+            value=float(value)
+        except (TypeError, ValueError):
+            return False
+        return (self.low is None or value>=self.low) and (self.high is None or value<=self.high)
+
+
+class nsd_searchexists:
+    '''NSD_SEARCHEXISTS - Search term that matches any metadata entry that has the parameter
+    An entry matches if the parameter is present and its value is not empty.'''
+    def matches(self, value):
+        '''MATCHES - Is VALUE present?'''
+        return value is not None and not (isinstance(value,str) and value=='')
+
+
+class nsd_searchpredicate:
+    '''NSD_SEARCHPREDICATE - One PARAM/VALUE pair of an NSD_DBLEAF_BRANCH search'''
+    def __init__(self, field, value):
+        '''NSD_SEARCHPREDICATE - Compile a search term
+        P = NSD_SEARCHPREDICATE(FIELD, VALUE)
+        P.COST orders the predicates from cheapest to most expensive to evaluate:
+        0 for exact matches (these can use the field index), 1 for ranges, 2 for
+        EXISTS and 3 for regular expressions.
+        A string without regular expression syntax is still a regular expression, one that
+        matches only itself; it is compared as text (P.TEXT is 1), so that '5' matches the
+        number 5 as '5|7' does.'''
+        self.field=field
+        self.value=value
+        self.regexp=None
+        self.text=int(isinstance(value,str))
+        if isinstance(value,nsd_searchrange):
+            self.cost=1
+        elif isinstance(value,nsd_searchexists):
+            self.cost=2
+        elif isinstance(value,str) and nsd_isregexp(value):
+            self.regexp=nsd_compileregexp(value)
+            self.cost=3
+        else:
+            self.cost=0
+
+    def matches(self, row):
+        '''MATCHES - Does the metadata entry ROW satisfy this search term?'''
+        if self.cost==0 and not self.text:
+            return row.get(self.field)==self.value
+        if self.field not in row:
+            return False
+        return self.matchesvalue(row[self.field])
+
+    def matchesvalue(self, value):
+        '''MATCHESVALUE - Does the value VALUE of the field satisfy this search term?'''
+        if self.cost==0:
+            if self.text and not isinstance(value,str):
+                return str(value)==self.value
+            return value==self.value
+        if self.regexp is not None:
+            return self.regexp.fullmatch(str(value)) is not None
+        return self.value.matches(value)
+
+    def indexkeys(self):
+        '''INDEXKEYS - The keys of the field index under which the matches of an exact term are
+        A text term can also match numbers and booleans whose string form it is; these are
+        looked up too, and the entries found must still be checked with MATCHES.'''
+        if not self.text:
+            return [nsd_indexkey(self.value)]
+        keys=[self.value]
+        for convert in (int,float):
+            try:
+                v=convert(self.value)
+            except ValueError:
+                continue
+            if str(v)==self.value:
+                keys.append(v)
+        if self.value in ('True','False','None'):
+            keys.append(ast.literal_eval(self.value))
+        return keys
+
+
+def nsd_isregexp(pattern):
+    '''NSD_ISREGEXP - Does the string PATTERN contain regular expression syntax?
+    Strings without any special characters match only themselves, so they can be
+    searched for as exact values.'''
+    return any(c in pattern for c in '.^$*+?{}[]\\|()')
+
+
+@functools.lru_cache(maxsize=256)
+def nsd_compileregexp(pattern):
+    '''NSD_COMPILEREGEXP - Compile (and cache) a regular expression used in a search'''
+    return re.compile(pattern)
+
+
+class nsd_leafstore:
+    '''NSD_LEAFSTORE - The objects of an NSD_DBLEAF_BRANCH that keeps them in memory (MEMORY=1)
+    Behaves like a list of the objects. If COMPACT is 0, the objects themselves are stored.
+    If COMPACT is 1, each object is stored as the UTF-8 text of its object file (see
+    NSD_BASE/STRINGDATATOSAVE) and a code for its class, which costs tens of bytes beyond
+    the text instead of a full object with its __dict__; indexing returns an NSD_LEAFPROXY.
+    Branches are always stored as objects, as their contents are not in their object file.'''
+    def __init__(self, compact=0, objs=()):
+        self.compact=compact
+        self.items=[] # the objects, or the bytes of their object files
+        self.classcodes=array.array('H') # index into CLASSES of the class of each item
+        self.classes=[]
+        self.extend(objs)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        for i in range(len(self.items)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        item=self.items[i]
+        if isinstance(item,bytes):
+            return nsd_leafproxy(self.classes[self.classcodes[i]],item)
+        return item
+
+    def __setitem__(self, i, obj):
+        self.items[i],self.classcodes[i]=self.pack(obj)
+
+    def extend(self, objs):
+        '''EXTEND - Append the objects OBJS'''
+        for obj in objs:
+            item,code=self.pack(obj)
+            self.items.append(item)
+            self.classcodes.append(code)
+
+    def take(self, indexes):
+        '''TAKE - Return a new store holding only the objects INDEXES, in order'''
+        new=nsd_leafstore(self.compact)
+        new.classes=self.classes
+        new.items=[self.items[i] for i in indexes]
+        new.classcodes=array.array('H',[self.classcodes[i] for i in indexes])
+        return new
+
+    def pack(self, obj):
+        '''PACK - Return the item to store for OBJ and the code of its class'''
+        cls=obj.__class__
+        if cls not in self.classes:
+            self.classes.append(cls)
+        code=self.classes.index(cls)
+        if isinstance(obj,nsd_leafproxy):
+            if self.compact and obj.leafobj is None:
+                return obj.leaftext,code
+            obj=obj.materialize() # it may have been changed since
+        if self.compact and not isinstance(obj,nsd_dbleaf_branch):
+            data,fieldnames=obj.stringdatatosave()
+            return '\n'.join(data).encode('utf-8'),code
+        return obj,code
+
+
+class nsd_leafproxy:
+    '''NSD_LEAFPROXY - Stand-in for an object of a compact NSD_LEAFSTORE
+    The first time an attribute is used, the object is read from its saved text with
+    CLS(TEXT,'OpenFile') and the attribute is taken from it. ISINSTANCE sees the class of
+    the object. The proxy cannot be changed; to change the object, change the one returned
+    by MATERIALIZE and save it with NSD_DBLEAF_BRANCH/UPDATE.'''
+    __slots__=('leafclass','leaftext','leafobj')
+
+    def __init__(self, leafclass, leaftext):
+        self.leafclass=leafclass
+        self.leaftext=leaftext
+        self.leafobj=None
+
+    @property
+    def __class__(self):
+        return self.leafclass
+
+    def materialize(self):
+        '''MATERIALIZE - Return the object, reading it from its text the first time'''
+        if self.leafobj is None:
+            self.leafobj=self.leafclass(io.StringIO(self.leaftext.decode('utf-8')),'OpenFile')
+        return self.leafobj
+
+    def __getattr__(self, name):
+        return getattr(self.materialize(),name)
+
+    def __setattr__(self, name, value):
+        if name not in nsd_leafproxy.__slots__:
+            raise Exception('Cannot set '+name+' of an NSD_LEAFPROXY; change the object returned by its MATERIALIZE and save that with NSD_DBLEAF_BRANCH/UPDATE.')
+        object.__setattr__(self,name,value)
+
+    def __repr__(self):
+        return '<nsd_leafproxy of '+self.leafclass.__name__+' '+self.leaftext.split(b'\n',2)[1].decode('utf-8')+'>'
+
+
+class nsd_metadatasummary:
+    '''NSD_METADATASUMMARY - A short description of the metadata of an NSD_DBLEAF_BRANCH
+    Records, for each field, its distinct values (as long as there are no more than
+    MAXVALUES of them) or else the range of its numeric values, and which entries are
+    sub-branches. MIGHTMATCH uses it to rule out a branch without searching it. MERGE adds
+    the description of other metadata, as for a whole tree (see SUBTREESUMMARY).'''
+    def __init__(self, md=(), maxvalues=64):
+        self.n=len(md)
+        self.maxvalues=maxvalues
+        self.values={} # field -> {(type, index key): value} of the distinct values, or None if there are too many
+        self.low={} # field -> smallest numeric value
+        self.high={} # field -> largest numeric value
+        self.other=set() # fields that have values that are not numbers
+        self.branches=[] # [index, objectfilename] of each entry that is an NSD_DBLEAF_BRANCH
+        for i,row in enumerate(md):
+            for f,v in row.items():
+                values=self.values.setdefault(f,{})
+                if values is not None:
+                    values.setdefault((type(v),nsd_indexkey(v)),v) # 5 and 5.0 are different text
+                    if len(values)>maxvalues:
+                        self.values[f]=None
+                if nsd_columnkind(v) in 'if':
+                    self.low[f]=min(self.low.get(f,v),v)
+                    self.high[f]=max(self.high.get(f,v),v)
+                elif not (isinstance(v,str) and v==''):
+                    self.other.add(f)
+            if row.get('is_nsd_dbleaf_branch') in (1,'1'):
+                self.branches.append([i,row.get('_objectfilename_')])
+
+    def mightmatch(self, predicate):
+        '''MIGHTMATCH - Could an entry satisfy the NSD_SEARCHPREDICATE PREDICATE?
+        Returns False only if no entry can match.'''
+        f=predicate.field
+        if not self.n or f not in self.values:
+            return False
+        if self.values[f] is not None:
+            return any(predicate.matchesvalue(v) for v in self.values[f].values())
+        if f in self.other or f not in self.low:
+            return True
+        if isinstance(predicate.value,nsd_searchrange):
+            r=predicate.value
+            return (r.low is None or self.high[f]>=r.low) and (r.high is None or self.low[f]<=r.high)
+        if predicate.cost==0 and nsd_columnkind(predicate.value) in 'if':
+            return self.low[f]<=predicate.value<=self.high[f]
+        return True
+
+    def merge(self, other):
+        '''MERGE - Add the entries described by the NSD_METADATASUMMARY OTHER to this summary
+        The entries of OTHER are not added to BRANCHES, which is about this metadata only.'''
+        self.n+=other.n
+        for f,values in other.values.items():
+            mine=self.values.setdefault(f,{})
+            if mine is None:
+                continue
+            if values is None:
+                self.values[f]=None
+                continue
+            for k,v in values.items():
+                mine.setdefault(k,v)
+            if len(mine)>self.maxvalues:
+                self.values[f]=None
+        for f,v in other.low.items():
+            self.low[f]=min(self.low.get(f,v),v)
+        for f,v in other.high.items():
+            self.high[f]=max(self.high.get(f,v),v)
+        self.other|=other.other
+
+    def todict(self, stamp):
+        '''TODICT - The summary as a dictionary for JSON, with the METADATASTAMP STAMP it describes
+        The values of a field are only kept if they are all numbers, strings or booleans, which
+        JSON reads back as they were.'''
+        scalar=(str,int,float,np.integer,np.floating,np.bool_)
+        values={}
+        for f,v in self.values.items():
+            if v is not None and all(isinstance(x,scalar) for x in v.values()):
+                values[f]=list(v.values())
+            else:
+                values[f]=None
+        return {'stamp':list(stamp) if stamp else None,'n':self.n,'maxvalues':self.maxvalues,
+            'values':values,'low':self.low,'high':self.high,'other':sorted(self.other)}
+
+
+def nsd_loadsummary(fname, stamp):
+    '''NSD_LOADSUMMARY - Read an NSD_METADATASUMMARY written by NSD_DBLEAF_BRANCH/SUBTREESUMMARY
+    Returns None if the file does not exist, is not complete, or describes metadata other than
+    that with the METADATASTAMP STAMP.'''
+    try:
+        with open(fname,'r') as fid:
+            d=json.load(fid)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(d,dict) or d.get('stamp')!=(list(stamp) if stamp else None):
+        return None
+    summary=nsd_metadatasummary((),d['maxvalues'])
+    summary.n=d['n']
+    for f,values in d['values'].items():
+        summary.values[f]=None if values is None else {(type(v),nsd_indexkey(v)):v for v in values}
+    summary.low=d['low']
+    summary.high=d['high']
+    summary.other=set(d['other'])
+    return summary
+
+
+def nsd_metadatastamp(mdfname):
+    '''NSD_METADATASTAMP - Identify the version of the metadata file MDFNAME and its journal
+    (see NSD_DBLEAF_BRANCH/METADATASTAMP)'''
+    stamp=()
+    for fname in (mdfname,mdfname+'.journal'):
+        try:
+            st=os.stat(fname)
+            stamp+=(st.st_mtime_ns,st.st_size)
+        except OSError:
+            stamp+=(None,None)
+    if stamp==(None,None,None,None):
+        return None
+    return stamp
+
+
+def nsd_invalidatesubtree(dirname, objectfilename):
+    '''NSD_INVALIDATESUBTREE - Remove the subtree summaries of a branch and of the branches above it
+    DIRNAME is the directory of the object file of the branch OBJECTFILENAME. The branches above
+    it are found from the names of the directories, as a branch keeps its items in the directory
+    OBJECTFILENAME.subdir.dbleaf_branch.nsd (or in a hash-prefix subdirectory of it, see LAYOUT).
+    The summaries are removed from the bottom up (see NSD_DBLEAF_BRANCH/SUBTREESUMMARY).'''
+    suffix='.subdir.dbleaf_branch.nsd'
+    while True:
+        try:
+            os.remove(dirname+'/'+objectfilename+'.subtree.dbleaf_branch.nsd')
+        except FileNotFoundError:
+            pass
+        base=os.path.basename(dirname)
+        if len(base)==2 and os.path.basename(os.path.dirname(dirname)).endswith(suffix):
+            dirname=os.path.dirname(dirname) # a hash-prefix subdirectory
+            base=os.path.basename(dirname)
+        if not base.endswith(suffix):
+            return
+        objectfilename=base[:-len(suffix)]
+        dirname=os.path.dirname(dirname)
+
+
+class nsd_stringtable:
+    '''NSD_STRINGTABLE - A table of distinct strings, each identified by an integer code
+    Code 0 is always the empty string.'''
+    def __init__(self, values=('',)):
+        self.values=list(values)
+        self.codes={v:i for i,v in enumerate(self.values)}
+
+    def code(self, value):
+        '''CODE - Return the code of the string VALUE, adding it to the table if needed'''
+        c=self.codes.get(value)
+        if c is None:
+            c=len(self.values)
+            self.values.append(value)
+            self.codes[value]=c
+        return c
+
+    def lookup(self, value):
+        '''LOOKUP - Return the code of the string VALUE, or -1 if it is not in the table'''
+        return self.codes.get(value,-1)
+
+    def string(self, c):
+        '''STRING - Return the string with code C'''
+        return self.values[c]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class nsd_metadatacolumns:
+    '''NSD_METADATACOLUMNS - NSD_DBLEAF_BRANCH metadata stored one column per field
+
+    Each field is held in one NumPy array. Columns of strings hold int32 codes into a
+    string table that is shared by all the columns (and by copies of the object), so
+    repeated values are stored once. Columns of integers or of floats hold int64 or
+    float64 values and a mask of the entries that are empty (''); any other column is
+    an object array.
+
+    The object behaves like the list of dictionaries returned by NSD_DBLEAF_BRANCH/METADATA:
+    MD[I] is a read-only dictionary view of entry I, MD[I:J] is a list of dictionaries,
+    and LEN, iteration and assignment of whole entries (MD[I] = ROW) work as for a list.'''
+    def __init__(self, md=(), strings=None):
+        '''NSD_METADATACOLUMNS - Create columnar metadata from a list of metadata structures'''
+        self.strings=strings if strings is not None else nsd_stringtable()
+        self.fields=[] # field names, in order
+        self.kinds={} # field -> 's' (string codes), 'i' (int64), 'f' (float64) or 'o' (object)
+        self.columns={} # field -> array of at least N values
+        self.missing={} # field -> bool array marking '' entries of 'i' and 'f' columns
+        self.n=0
+        self.extend(md)
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield nsd_metadatarow(self,i)
+
+    def __getitem__(self, i):
+        if isinstance(i,slice):
+            return [dict(nsd_metadatarow(self,j)) for j in range(self.n)[i]]
+        if i<0:
+            i+=self.n
+        if not 0<=i<self.n:
+            raise IndexError('metadata index out of range')
+        return nsd_metadatarow(self,i)
+
+    def __setitem__(self, i, row):
+        if i<0:
+            i+=self.n
+        if not 0<=i<self.n:
+            raise IndexError('metadata index out of range')
+        for f in row:
+            if f not in self.kinds:
+                self.addcolumn(f)
+        for f in self.fields:
+            self.setvalues(f,i,[row.get(f,'')])
+
+    def value(self, field, i):
+        '''VALUE - Return the value of FIELD in entry I'''
+        kind=self.kinds[field]
+        v=self.columns[field][i]
+        if kind=='s':
+            return self.strings.string(v)
+        if kind=='o':
+            return v
+        if self.missing[field][i]:
+            return ''
+        return int(v) if kind=='i' else float(v)
+
+    def extend(self, rows):
+        '''EXTEND - Append metadata structures to the columns
+        Fields that are new are added to all existing entries as ''. Entries that lack a
+        field get ''. Returns 1 if fields were added to existing entries (or there were
+        no entries before), and 0 otherwise.'''
+        rows=[row for row in rows if row]
+        if not rows:
+            return 0
+        changed=int(self.n==0)
+        for row in rows:
+            for f in row:
+                if f not in self.kinds:
+                    self.addcolumn(f)
+                    changed=1
+        self.reserve(self.n+len(rows))
+        for f in self.fields:
+            self.setvalues(f,self.n,[row.get(f,'') for row in rows])
+        self.n+=len(rows)
+        return changed
+
+    def addcolumn(self, field):
+        '''ADDCOLUMN - Add a field whose value is '' in all existing entries'''
+        self.columns[field]=np.zeros(self.capacity(),dtype=np.int32)
+        self.fields.append(field)
+        self.kinds[field]='s'
+
+    def capacity(self):
+        '''CAPACITY - Number of entries the column arrays can hold without growing'''
+        if not self.fields:
+            return self.n
+        return len(self.columns[self.fields[0]])
+
+    def reserve(self, n):
+        '''RESERVE - Make room in all columns for at least N entries'''
+        cap=self.capacity()
+        if n<=cap:
+            return
+        cap=max(n,2*cap,16)
+        for f in self.fields:
+            self.columns[f]=nsd_growarray(self.columns[f],cap)
+            if f in self.missing:
+                self.missing[f]=nsd_growarray(self.missing[f],cap)
+
+    def setvalues(self, field, start, values):
+        '''SETVALUES - Store VALUES in FIELD for entries START, START+1, ...
+        The kind of the column is changed if the values do not fit it.'''
+        kind=self.kinds[field]
+        stop=start+len(values)
+        if kind=='s' and all(isinstance(v,str) for v in values):
+            self.columns[field][start:stop]=[self.strings.code(v) for v in values]
+        elif kind in 'if' and all(nsd_columnkind(v)==kind or v=='' for v in values):
+            self.columns[field][start:stop]=[0 if isinstance(v,str) else v for v in values]
+            self.missing[field][start:stop]=[isinstance(v,str) for v in values]
+        elif kind=='o':
+            for j in range(len(values)):
+                self.columns[field][start+j]=values[j]
+        else:
+            allvalues=[self.value(field,i) for i in range(self.n)]
+            allvalues[start:stop]=values
+            self.buildcolumn(field,allvalues)
+
+    def buildcolumn(self, field, values):
+        '''BUILDCOLUMN - (Re)create the column FIELD from the list VALUES'''
+        kinds={nsd_columnkind(v) for v in values if not (isinstance(v,str) and v=='')}
+        kind=kinds.pop() if len(kinds)==1 else ('s' if not kinds else 'o')
+        cap=max(self.capacity(),len(values))
+        self.missing.pop(field,None)
+        if kind=='s':
+            column=np.zeros(cap,dtype=np.int32)
+            column[:len(values)]=[self.strings.code(v) for v in values]
+        elif kind in 'if':
+            try:
+                column=np.zeros(cap,dtype=np.int64 if kind=='i' else np.float64)
+                column[:len(values)]=[0 if isinstance(v,str) else v for v in values]
+                self.missing[field]=np.zeros(cap,dtype=bool)
+                self.missing[field][:len(values)]=[isinstance(v,str) for v in values]
+            except OverflowError:
+                self.missing.pop(field,None)
+                kind='o'
+        if kind=='o':
+            column=np.full(cap,'',dtype=object)
+            for j in range(len(values)):
+                column[j]=values[j]
+        self.kinds[field]=kind
+        self.columns[field]=column
+
+    def copy(self):
+        '''COPY - Return a copy that can be modified independently (the string table is shared)'''
+        new=nsd_metadatacolumns(strings=self.strings)
+        new.fields=list(self.fields)
+        new.kinds=dict(self.kinds)
+        new.columns={f:c.copy() for f,c in self.columns.items()}
+        new.missing={f:m.copy() for f,m in self.missing.items()}
+        new.n=self.n
+        return new
+
+    def take(self, indexes):
+        '''TAKE - Return new columnar metadata holding only the entries INDEXES, in order'''
+        indexes=np.asarray(indexes,dtype=np.int64)
+        new=nsd_metadatacolumns(strings=self.strings)
+        new.fields=list(self.fields)
+        new.kinds=dict(self.kinds)
+        new.columns={f:c[indexes] for f,c in self.columns.items()}
+        new.missing={f:m[indexes] for f,m in self.missing.items()}
+        new.n=len(indexes)
+        return new
+
+    def tolist(self):
+        '''TOLIST - Return the metadata as a list of dictionaries'''
+        return [dict(nsd_metadatarow(self,i)) for i in range(self.n)]
+
+    def groupindex(self, field):
+        '''GROUPINDEX - Return a dictionary mapping each value of FIELD to the entries that have it'''
+        if field not in self.kinds:
+            return {}
+        if self.kinds[field]=='o':
+            idx={}
+            for i in range(self.n):
+                idx.setdefault(nsd_indexkey(self.value(field,i)),[]).append(i)
+            return idx
+        column=self.columns[field][:self.n]
+        if field in self.missing:
+            # keep '' apart from the 0 stored in its place
+            column=np.where(self.missing[field][:self.n],np.nan,column)
+        order=np.argsort(column,kind='stable')
+        values,starts=np.unique(column[order],return_index=True)
+        idx={}
+        for g in np.split(order,starts[1:]):
+            if len(g):
+                idx[nsd_indexkey(self.value(field,int(g[0])))]=g.tolist()
+        return idx
+
+    def match(self, predicate, rows=None):
+        '''MATCH - Evaluate an NSD_SEARCHPREDICATE on a whole column
+        Returns a boolean array with one element for each entry in ROWS (an array of
+        entry indexes), or for each entry if ROWS is None.'''
+        n=self.n if rows is None else len(rows)
+        field=predicate.field
+        if field not in self.kinds:
+            return np.zeros(n,dtype=bool)
+        kind=self.kinds[field]
+        column=self.columns[field][:self.n]
+        if rows is not None:
+            column=column[rows]
+        if kind=='s':
+            if predicate.cost==0:
+                if not isinstance(predicate.value,str):
+                    return np.zeros(n,dtype=bool)
+                return column==self.strings.lookup(predicate.value)
+            if isinstance(predicate.value,nsd_searchexists):
+                return column!=0
+            # evaluate once per distinct string, then look the answers up by code
+            codes,inverse=np.unique(column,return_inverse=True)
+            lut=np.array([predicate.matchesvalue(self.strings.string(c)) for c in codes],dtype=bool)
+            return lut[inverse].reshape(n)
+        if kind=='o':
+            return np.fromiter((predicate.matchesvalue(v) for v in column),dtype=bool,count=n)
+        missing=self.missing[field][:self.n]
+        if rows is not None:
+            missing=missing[rows]
+        if isinstance(predicate.value,nsd_searchexists):
+            return ~missing
+        if isinstance(predicate.value,nsd_searchrange):
+            m=~missing
+            if predicate.value.low is not None:
+                m&=column>=predicate.value.low
+            if predicate.value.high is not None:
+                m&=column<=predicate.value.high
+            return m
+        if predicate.cost==0 and nsd_columnkind(predicate.value) in 'if':
+            return (column==predicate.value)&~missing
+        values,inverse=np.unique(column,return_inverse=True)
+        lut=np.array([predicate.matchesvalue(int(v) if kind=='i' else float(v)) for v in values],dtype=bool)
+        m=lut[inverse].reshape(n)
+        m[missing]=predicate.matchesvalue('')
+        return m
+
+
+class nsd_metadatarow(collections.abc.Mapping):
+    '''NSD_METADATAROW - Read-only dictionary view of one entry of NSD_METADATACOLUMNS'''
+    __slots__=('columns','row')
+
+    def __init__(self, columns, row):
+        self.columns=columns
+        self.row=row
+
+    def __getitem__(self, field):
+        if field not in self.columns.kinds:
+            raise KeyError(field)
+        return self.columns.value(field,self.row)
+
+    def __iter__(self):
+        return iter(self.columns.fields)
+
+    def __len__(self):
+        return len(self.columns.fields)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def nsd_columnkind(value):
+    '''NSD_COLUMNKIND - The NSD_METADATACOLUMNS column kind that can hold VALUE'''
+    if isinstance(value,str):
+        return 's'
+    if isinstance(value,(bool,np.bool_)):
+        return 'o'
+    if isinstance(value,(int,np.integer)):
+        return 'i'
+    if isinstance(value,(float,np.floating)):
+        return 'f'
+    return 'o'
+
+
+def nsd_growarray(a, n):
+    '''NSD_GROWARRAY - Return a copy of the array A lengthened to N elements'''
+    if a.dtype==object:
+        new=np.full(n,'',dtype=object)
+    else:
+        new=np.zeros(n,dtype=a.dtype)
+    new[:len(a)]=a
+    return new
+
+
+class nsd_heapstringtable(nsd_stringtable):
+    '''NSD_HEAPSTRINGTABLE - String table read from the string heap of a binary metadata file
+    The strings of the heap are sorted, so they are decoded only when they are asked for
+    and looked up by binary search. Strings added later get codes after the heap.'''
+    def __init__(self, buf, offsets, start):
+        self.buf=buf # the (memory-mapped) file
+        self.offsets=offsets # byte offset of each string in the heap, plus the end
+        self.start=start # file offset of the heap bytes
+        self.nheap=len(offsets)-1
+        super().__init__(())
+
+    def __len__(self):
+        return self.nheap+len(self.values)
+
+    def string(self, c):
+        if c<self.nheap:
+            return self.heapbytes(c).decode('utf-8')
+        return self.values[c-self.nheap]
+
+    def heapbytes(self, c):
+        '''HEAPBYTES - Return the UTF-8 bytes of heap string C'''
+        return bytes(self.buf[self.start+int(self.offsets[c]):self.start+int(self.offsets[c+1])])
+
+    def code(self, value):
+        c=self.lookup(value)
+        if c<0:
+            c=self.nheap+len(self.values)
+            self.values.append(value)
+            self.codes[value]=c
+        return c
+
+    def lookup(self, value):
+        target=value.encode('utf-8')
+        lo,hi=0,self.nheap
+        while lo<hi:
+            mid=(lo+hi)//2
+            if self.heapbytes(mid)<target:
+                lo=mid+1
+            else:
+                hi=mid
+        if lo<self.nheap and self.heapbytes(lo)==target:
+            return lo
+        return self.codes.get(value,-1)
+
+
+nsd_binarymetadata_magic=b'NSDMDB\x00\x00'
+nsd_binarymetadata_version=1
+nsd_binarymetadata_header=struct.Struct('<8sIIQQ') # magic, version, nfields, nrows, heap offset
+nsd_binarymetadata_field=struct.Struct('<c3xIQQ') # kind, name length, column offset, mask offset
+
+
+def nsd_binarymetadataheader(fname):
+    '''NSD_BINARYMETADATAHEADER - Read the header of a binary metadata file
+    [VERSION, NFIELDS, NROWS] = NSD_BINARYMETADATAHEADER(FNAME)
+    Returns None if FNAME is not a binary metadata file.'''
+    try:
+        with open(fname,'rb') as fid:
+            header=fid.read(nsd_binarymetadata_header.size)
+    except OSError:
+        return None
+    if len(header)<nsd_binarymetadata_header.size or not header.startswith(nsd_binarymetadata_magic):
+        return None
+    magic,version,nfields,nrows,heapoffset=nsd_binarymetadata_header.unpack(header)
+    return [version,nfields,nrows]
+
+
+def nsd_loadmetadatafile(fname):
+    '''NSD_LOADMETADATAFILE - Read a metadata file in either the text or the binary format
+    Text files are read with loadStructArray and give a list of dictionaries; binary
+    files give an NSD_METADATACOLUMNS object (see NSD_READBINARYMETADATA).'''
+    if nsd_binarymetadataheader(fname) is not None:
+        return nsd_readbinarymetadata(fname)
+    return nsd_stats.call('loadStructArray',loadStructArray,fname)
+
+
+@nsd_instrumented('readbinarymetadata')
+def nsd_readbinarymetadata(fname):
+    '''NSD_READBINARYMETADATA - Read a binary metadata file
+    MD = NSD_READBINARYMETADATA(FNAME)
+    The file is memory-mapped and returned as an NSD_METADATACOLUMNS object whose string,
+    integer and float columns are read-only views of the mapped file, so a column is
+    only read from disk when it is used. Call COPY before modifying MD.
+
+    File layout (little-endian, sections aligned to 8 bytes):
+      header    magic 'NSDMDB', version, number of fields, number of rows, heap offset
+      schema    for each field: kind ('s','i','f' or 'j'), name length, column offset,
+                mask offset; followed by the UTF-8 field names
+      columns   's' and 'j': int32 codes into the string heap ('j' strings are JSON)
+                'i': int64 values, 'f': float64 values, each followed by a uint8 mask
+                of the entries that are ''
+      heap      number of strings, (number+1) uint64 offsets, sorted UTF-8 strings'''
+    with open(fname,'rb') as fid:
+        buf=mmap.mmap(fid.fileno(),0,access=mmap.ACCESS_READ)
+    magic,version,nfields,nrows,heapoffset=nsd_binarymetadata_header.unpack_from(buf,0)
+    if magic!=nsd_binarymetadata_magic:
+        raise Exception('Not a binary metadata file: '+fname)
+    if version>nsd_binarymetadata_version:
+        raise Exception('Binary metadata file '+fname+' has version '+str(version)+', which is newer than this code can read.')
+    nstrings=struct.unpack_from('<Q',buf,heapoffset)[0]
+    offsets=np.frombuffer(buf,dtype='<u8',count=nstrings+1,offset=heapoffset+8)
+    strings=nsd_heapstringtable(buf,offsets,heapoffset+8+8*(nstrings+1))
+    md=nsd_metadatacolumns(strings=strings)
+    pos=nsd_binarymetadata_header.size+nfields*nsd_binarymetadata_field.size
+    for k in range(nfields):
+        kind,namelen,coloffset,maskoffset=nsd_binarymetadata_field.unpack_from(buf,nsd_binarymetadata_header.size+k*nsd_binarymetadata_field.size)
+        field=bytes(buf[pos:pos+namelen]).decode('utf-8')
+        pos+=namelen
+        kind=kind.decode('ascii')
+        if kind in 'sj':
+            column=np.frombuffer(buf,dtype='<i4',count=nrows,offset=coloffset)
+        else:
+            column=np.frombuffer(buf,dtype='<i8' if kind=='i' else '<f8',count=nrows,offset=coloffset)
+            md.missing[field]=np.frombuffer(buf,dtype=bool,count=nrows,offset=maskoffset)
+        if kind=='j':
+            values=np.full(nrows,'',dtype=object)
+            for i in range(nrows):
+                values[i]=json.loads(strings.string(column[i]))
+            column,kind=values,'o'
+        md.fields.append(field)
+        md.kinds[field]=kind
+        md.columns[field]=column
+    md.n=nrows
+    return md
+
+
+@nsd_instrumented('writebinarymetadata')
+def nsd_writebinarymetadata(fname, md):
+    '''NSD_WRITEBINARYMETADATA - Write metadata to a file in the binary format
+    MD may be a list of metadata structures or an NSD_METADATACOLUMNS object. The file is
+    written under a temporary name, flushed to disk and then renamed into place, so that
+    readers that have the old file memory-mapped keep a consistent copy.
+    See also: NSD_READBINARYMETADATA'''
+    if not isinstance(md,nsd_metadatacolumns):
+        md=nsd_metadatacolumns(md)
+    n=len(md)
+    # collect the strings that are used, to build the (sorted) heap
+    used={}
+    jsonvalues={}
+    for f in md.fields:
+        column=md.columns[f][:n]
+        if md.kinds[f]=='s':
+            used[f]=np.unique(column)
+        elif md.kinds[f]=='o':
+            jsonvalues[f]=[json.dumps(v,default=nsd_jsonvalue) for v in column]
+    heap={''}
+    for f,codes in used.items():
+        heap.update(md.strings.string(c) for c in codes)
+    for values in jsonvalues.values():
+        heap.update(values)
+    heap=sorted(heap,key=lambda v:v.encode('utf-8'))
+    heapcodes={v:i for i,v in enumerate(heap)}
+    # lay out the sections
+    names=[f.encode('utf-8') for f in md.fields]
+    pos=nsd_align8(nsd_binarymetadata_header.size+len(names)*nsd_binarymetadata_field.size+sum(len(b) for b in names))
+    entries=[]
+    blocks=[]
+    for f in md.fields:
+        kind=md.kinds[f]
+        if kind=='s':
+            lut=np.zeros(int(used[f].max())+1 if len(used[f]) else 1,dtype='<i4')
+            lut[used[f]]=[heapcodes[md.strings.string(c)] for c in used[f]]
+            data=lut[md.columns[f][:n]].astype('<i4').tobytes()
+            mask=None
+        elif kind=='o':
+            kind='j'
+            data=np.array([heapcodes[v] for v in jsonvalues[f]],dtype='<i4').tobytes()
+            mask=None
+        else:
+            data=md.columns[f][:n].astype('<i8' if kind=='i' else '<f8').tobytes()
+            mask=md.missing[f][:n].astype(np.uint8).tobytes()
+        coloffset=pos
+        pos=nsd_align8(pos+len(data))
+        blocks.append((coloffset,data))
+        maskoffset=0
+        if mask is not None:
+            maskoffset=pos
+            pos=nsd_align8(pos+len(mask))
+            blocks.append((maskoffset,mask))
+        entries.append(nsd_binarymetadata_field.pack(kind.encode('ascii'),len(f.encode('utf-8')),coloffset,maskoffset))
+    heapbytes=[v.encode('utf-8') for v in heap]
+    offsets=np.zeros(len(heap)+1,dtype='<u8')
+    offsets[1:]=np.cumsum([len(b) for b in heapbytes])
+    heapoffset=pos
+    tmpname=nsd_tempfilename(fname)
+    with open(tmpname,'wb') as fid:
+        fid.write(nsd_binarymetadata_header.pack(nsd_binarymetadata_magic,nsd_binarymetadata_version,len(md.fields),n,heapoffset))
+        fid.write(b''.join(entries)+b''.join(names))
+        for offset,data in blocks:
+            fid.write(b'\x00'*(offset-fid.tell()))
+            fid.write(data)
+        fid.write(b'\x00'*(heapoffset-fid.tell()))
+        fid.write(struct.pack('<Q',len(heap)))
+        fid.write(offsets.tobytes())
+        fid.write(b''.join(heapbytes))
+        if nsd_stats.enabled:
+            nsd_stats.record('writebinarymetadata',byteswritten=fid.tell(),calls=0)
+    nsd_replacefile(tmpname,fname)
+
+
+def nsd_align8(n):
+    '''NSD_ALIGN8 - Round N up to a multiple of 8'''
+    return (n+7)//8*8
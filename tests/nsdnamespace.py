@@ -0,0 +1,79 @@
+'''The NSD database files executed into one namespace, for the tests.
+
+Database file1.py and Database file2.py are executed into a namespace of their own, as
+the rest of NSD does. The NSD functions they use from elsewhere (saveStructArray,
+loadStructArray, structmerge, nsd_pickdbleaf and the class nsd_dbleaf) are replaced by
+the small stand-ins below.'''
+import ast
+import os
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def structmerge(a, b):
+    '''STRUCTMERGE - the fields of A, with those of B added or replaced'''
+    return {**a, **b}
+
+
+def saveStructArray(fname, md):
+    '''SAVESTRUCTARRAY - write a list of dictionaries as tab-separated values'''
+    md = list(md)
+    with open(fname, 'w') as fid:
+        if not md:
+            return
+        fields = list(md[0])
+        fid.write('\t'.join(fields) + '\n')
+        for row in md:
+            fid.write('\t'.join(repr(row.get(f, '')) for f in fields) + '\n')
+
+
+def loadStructArray(fname):
+    '''LOADSTRUCTARRAY - read a file written by SAVESTRUCTARRAY'''
+    with open(fname) as fid:
+        lines = fid.read().split('\n')
+    if not lines[0]:
+        return []
+    fields = lines[0].split('\t')
+    return [{f: ast.literal_eval(v) for f, v in zip(fields, line.split('\t'))} for line in lines[1:] if line]
+
+
+def execfile(filename, namespace):
+    with open(os.path.join(here, filename)) as fid:
+        exec(compile(fid.read(), filename, 'exec'), namespace)
+
+
+nsd = {'__name__': 'nsd_test', 'structmerge': structmerge,
+       'saveStructArray': saveStructArray, 'loadStructArray': loadStructArray}
+execfile('Database file1.py', nsd)
+
+
+class nsd_dbleaf(nsd['nsd_base']):
+    '''NSD_DBLEAF - a leaf with a name, which is its only metadata'''
+    def __init__(self, name='', command=''):
+        self._name_ = ''
+        if command.lower() == 'openfile':
+            super().__init__(name, command)
+        else:
+            super().__init__()
+            self._name_ = name
+
+    def metadatastruct(self):
+        return {'_name_': self._name_, '_objectfilename_': self._objectfilename_}
+
+    def stringdatatosave(self):
+        data, fieldnames = super().stringdatatosave()
+        data.append(self._name_)
+        fieldnames.append('$name')
+        return data, fieldnames
+
+
+def nsd_pickdbleaf(filename):
+    '''NSD_PICKDBLEAF - open the object file FILENAME with the class named on its first line'''
+    with open(filename) as fid:
+        classname = fid.readline().rstrip('\n')
+    return nsd[classname](filename, 'OpenFile')
+
+
+nsd['nsd_dbleaf'] = nsd_dbleaf
+nsd['nsd_pickdbleaf'] = nsd_pickdbleaf
+execfile('Database file2.py', nsd)
@@ -0,0 +1,81 @@
+'''Tests of the binary metadata file format (NSD_WRITEBINARYMETADATA, NSD_READBINARYMETADATA).'''
+import os
+
+import pytest
+
+from nsdnamespace import nsd
+
+rows = [
+    {'name': 'alpha', 'count': 1, 'weight': 0.5, 'tags': [1, 2], 'label': 'café'},
+    {'name': 'beta', 'count': '', 'weight': '', 'tags': {'k': 'v'}, 'label': ''},
+    {'name': 'alpha', 'count': -7, 'weight': 1e300, 'tags': None, 'label': '中文'},
+]
+
+
+@pytest.fixture
+def mdname(tmp_path):
+    return str(tmp_path / 'branch.metadata.dbleaf_branch.nsd')
+
+
+def test_round_trip_keeps_every_kind_of_column(mdname):
+    nsd['nsd_writebinarymetadata'](mdname, rows)
+    assert nsd['nsd_binarymetadataheader'](mdname) == [nsd['nsd_binarymetadata_version'], 5, 3]
+    md = nsd['nsd_readbinarymetadata'](mdname)
+    assert md.kinds == {'name': 's', 'count': 'i', 'weight': 'f', 'tags': 'o', 'label': 's'}
+    assert [dict(row) for row in md] == rows
+    assert nsd['nsd_loadmetadatafile'](mdname)[0:3] == rows
+
+
+def test_round_trip_of_columns_and_of_a_file_read_back(mdname, tmp_path):
+    nsd['nsd_writebinarymetadata'](mdname, nsd['nsd_metadatacolumns'](rows))
+    other = str(tmp_path / 'other.nsd')
+    nsd['nsd_writebinarymetadata'](other, nsd['nsd_readbinarymetadata'](mdname))
+    with open(mdname, 'rb') as a, open(other, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_empty_metadata(mdname):
+    nsd['nsd_writebinarymetadata'](mdname, [])
+    assert nsd['nsd_binarymetadataheader'](mdname) == [nsd['nsd_binarymetadata_version'], 0, 0]
+    assert len(nsd['nsd_readbinarymetadata'](mdname)) == 0
+
+
+def test_reader_keeps_its_copy_when_the_file_is_rewritten(mdname):
+    nsd['nsd_writebinarymetadata'](mdname, rows)
+    md = nsd['nsd_readbinarymetadata'](mdname)
+    nsd['nsd_writebinarymetadata'](mdname, [{'name': 'gamma'}])
+    assert [dict(row) for row in md] == rows
+    assert [dict(row) for row in nsd['nsd_readbinarymetadata'](mdname)] == [{'name': 'gamma'}]
+    assert os.listdir(os.path.dirname(mdname)) == [os.path.basename(mdname)]
+
+
+def test_text_and_short_files_are_not_binary(mdname):
+    nsd['saveStructArray'](mdname, rows[0:1])
+    assert nsd['nsd_binarymetadataheader'](mdname) is None
+    assert nsd['nsd_loadmetadatafile'](mdname) == rows[0:1]
+    with open(mdname, 'wb') as fid:
+        fid.write(nsd['nsd_binarymetadata_magic'])
+    assert nsd['nsd_binarymetadataheader'](mdname) is None
+    assert nsd['nsd_binarymetadataheader'](mdname + '.missing') is None
+
+
+def test_newer_version_is_refused(mdname):
+    nsd['nsd_writebinarymetadata'](mdname, rows)
+    header = nsd['nsd_binarymetadata_header']
+    with open(mdname, 'r+b') as fid:
+        fields = list(header.unpack(fid.read(header.size)))
+        fields[1] = nsd['nsd_binarymetadata_version'] + 1
+        fid.seek(0)
+        fid.write(header.pack(*fields))
+    with pytest.raises(Exception, match='newer'):
+        nsd['nsd_readbinarymetadata'](mdname)
+
+
+def test_branch_reads_back_binary_metadata(tmp_path):
+    branch = nsd['nsd_dbleaf_branch'](str(tmp_path), 'root', ['nsd_dbleaf'], binary=1)
+    for name in ('a', 'b', 'c'):
+        branch.add(nsd['nsd_dbleaf'](name))
+    assert nsd['nsd_binarymetadataheader'](branch.metadatafilename()) is not None
+    reopened = nsd['nsd_dbleaf_branch'](str(tmp_path / branch._objectfilename_), 'OpenFile')
+    assert [row['_name_'] for row in reopened.metadata()] == ['a', 'b', 'c']
+    assert reopened.load('_name_', 'b')[0]._name_ == 'b'
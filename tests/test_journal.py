@@ -0,0 +1,102 @@
+'''Tests of the metadata journal of NSD_DBLEAF_BRANCH (NSD_REPLAYJOURNAL) and of its recovery
+from interrupted writes and compactions.'''
+import json
+import os
+import shutil
+
+import pytest
+
+from nsdnamespace import nsd
+
+base = [1234, 56]
+
+
+def writejournal(fname, *records, base=base, tail=''):
+    with open(fname, 'w') as fid:
+        fid.write(json.dumps({'base': base}) + '\n')
+        for record in records:
+            fid.write(json.dumps(record) + '\n')
+        fid.write(tail)
+
+
+@pytest.fixture
+def jname(tmp_path):
+    return str(tmp_path / 'branch.metadata.dbleaf_branch.nsd.journal')
+
+
+def test_replay_add_update_remove(jname):
+    md = [{'_name_': 'a'}, {'_name_': 'b'}]
+    writejournal(jname, {'add': [{'_name_': 'c'}]}, {'update': {'0': {'_name_': 'A'}}}, {'remove': [1]})
+    assert nsd['nsd_journalbase'](jname) == base
+    assert nsd['nsd_replayjournal'](md, jname, tuple(base)) == [{'_name_': 'A'}, {'_name_': 'c'}]
+    assert md == [{'_name_': 'a'}, {'_name_': 'b'}]
+
+
+def test_replay_on_columns(jname):
+    md = nsd['nsd_metadatacolumns']([{'_name_': 'a', 'n': 1}, {'_name_': 'b', 'n': 2}])
+    writejournal(jname, {'add': [{'_name_': 'c', 'n': 3}]}, {'update': {'1': {'_name_': 'B', 'n': ''}}}, {'remove': [0]})
+    md = nsd['nsd_replayjournal'](md, jname, tuple(base))
+    assert [dict(row) for row in md] == [{'_name_': 'B', 'n': ''}, {'_name_': 'c', 'n': 3}]
+
+
+def test_journal_of_another_metadata_file_is_ignored(jname):
+    md = [{'_name_': 'a'}]
+    writejournal(jname, {'add': [{'_name_': 'b'}]}, base=[1234, 57])
+    assert nsd['nsd_replayjournal'](md, jname, tuple(base)) is md
+
+
+def test_partly_written_last_record_is_ignored(jname):
+    writejournal(jname, {'add': [{'_name_': 'b'}]}, tail='{"add": [{"_name_": "c"')
+    assert nsd['nsd_replayjournal']([{'_name_': 'a'}], jname, tuple(base)) == [{'_name_': 'a'}, {'_name_': 'b'}]
+
+
+def test_missing_or_empty_journal(jname):
+    md = [{'_name_': 'a'}]
+    assert nsd['nsd_journalbase'](jname) is None
+    assert nsd['nsd_replayjournal'](md, jname, tuple(base)) is md
+    open(jname, 'w').close()
+    assert nsd['nsd_journalbase'](jname) is None
+    assert nsd['nsd_replayjournal'](md, jname, tuple(base)) is md
+
+
+def branchwithjournal(path):
+    branch = nsd['nsd_dbleaf_branch'](path, 'root', ['nsd_dbleaf'], journal=100000)
+    for name in ('a', 'b', 'c'):
+        branch.add(nsd['nsd_dbleaf'](name))
+    return branch
+
+
+def reopen(path, branch):
+    return nsd['nsd_dbleaf_branch'](os.path.join(path, branch._objectfilename_), 'OpenFile')
+
+
+def names(branch):
+    return [row['_name_'] for row in branch.metadata()]
+
+
+def test_branch_changes_go_to_the_journal_and_are_read_back(tmp_path):
+    branch = branchwithjournal(str(tmp_path))
+    branch.remove(branch.load('_name_', 'b')[0]._objectfilename_)
+    leaf = branch.load('_name_', 'c')[0]
+    leaf._name_ = 'C'
+    branch.update(leaf)
+    assert os.path.isfile(branch.journalfilename())
+    assert names(reopen(str(tmp_path), branch)) == ['a', 'C']
+    branch.compact()
+    assert not os.path.isfile(branch.journalfilename())
+    assert names(reopen(str(tmp_path), branch)) == ['a', 'C']
+
+
+def test_journal_left_by_an_interrupted_compaction_is_not_replayed(tmp_path):
+    branch = branchwithjournal(str(tmp_path))
+    jname = branch.journalfilename()
+    shutil.copy(jname, jname + '.old')
+    branch.compact()
+    # the compaction replaced the metadata file but stopped before removing the journal
+    os.rename(jname + '.old', jname)
+    reopened = reopen(str(tmp_path), branch)
+    assert names(reopened) == ['a', 'b', 'c']
+    # the next change starts a new journal against the new metadata file
+    reopened.add(nsd['nsd_dbleaf']('d'))
+    assert nsd['nsd_journalbase'](jname) == list(reopened.metadatastamp()[0:2])
+    assert names(reopen(str(tmp_path), branch)) == ['a', 'b', 'c', 'd']
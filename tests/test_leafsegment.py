@@ -0,0 +1,110 @@
+'''Tests of the leaf segment file of a PACKED branch (NSD_LEAFSEGMENT): its records, their
+recovery from an interrupted append, and compaction.'''
+import contextlib
+import os
+
+import pytest
+
+from nsdnamespace import nsd
+
+
+@pytest.fixture
+def segname(tmp_path):
+    return str(tmp_path / 'branch.segment.dbleaf_branch.nsd')
+
+
+def segment(filename):
+    '''SEGMENT - a new NSD_LEAFSEGMENT of FILENAME, as another process would open it'''
+    return nsd['nsd_leafsegment'](filename).refresh()
+
+
+def contents(seg):
+    return {name: bytes(seg.read(name)) for name in seg.index}
+
+
+def test_round_trip_of_added_replaced_and_removed_objects(segname):
+    seg = nsd['nsd_leafsegment'](segname)
+    seg.append([['a', b'text of a'], ['b', b'text of b'], ['é', b'']])
+    seg.append([['a', b'new text of a'], ['b', None]])
+    expected = {'a': b'new text of a', 'é': b''}
+    assert contents(seg) == expected
+    assert contents(segment(segname)) == expected
+    assert seg.dead > 0
+    assert seg.locate('b') is None
+    assert seg.locate('a')[0][0] == seg.token
+
+
+def test_reader_picks_up_records_appended_later(segname):
+    writer = nsd['nsd_leafsegment'](segname)
+    writer.append([['a', b'1']])
+    reader = segment(segname)
+    writer.append([['b', b'2']])
+    assert contents(reader.refresh()) == {'a': b'1', 'b': b'2'}
+
+
+def test_partly_written_record_is_ignored_and_cut_off_by_the_next_append(segname):
+    seg = nsd['nsd_leafsegment'](segname)
+    seg.append([['a', b'text of a']])
+    size = os.path.getsize(segname)
+    record = nsd['nsd_leafsegment_record'].pack(b'L', 1, 100, 0) + b'b' + b'x' * 10
+    for partial in (record[0:5], record):
+        with open(segname, 'ab') as fid:
+            fid.write(partial)
+        reader = segment(segname)
+        assert contents(reader) == {'a': b'text of a'}
+        assert reader.end == size
+        os.truncate(segname, size)
+    with open(segname, 'ab') as fid:
+        fid.write(record)
+    seg.append([['c', b'text of c']])
+    assert contents(segment(segname)) == {'a': b'text of a', 'c': b'text of c'}
+    assert os.path.getsize(segname) == segment(segname).end
+
+
+def test_corrupt_record_is_detected(segname):
+    seg = nsd['nsd_leafsegment'](segname)
+    seg.append([['a', b'text of a']])
+    with open(segname, 'r+b') as fid:
+        fid.seek(-1, os.SEEK_END)
+        fid.write(b'A')
+    with pytest.raises(Exception, match='corrupt'):
+        segment(segname).read('a')
+
+
+def test_other_files_are_refused(segname):
+    with open(segname, 'wb') as fid:
+        fid.write(b'x' * 64)
+    with pytest.raises(Exception, match='Not a leaf segment'):
+        segment(segname)
+
+
+def test_compact_keeps_the_live_records_and_those_appended_meanwhile(segname):
+    seg = nsd['nsd_leafsegment'](segname)
+    seg.append([['a', b'old a'], ['b', b'text of b'], ['c', b'text of c']])
+    seg.append([['a', b'new a'], ['c', None]])
+    token, size = seg.token, os.path.getsize(segname)
+    reader = segment(segname)
+
+    @contextlib.contextmanager
+    def locked():
+        # another writer appended while the live records were being copied
+        segment(segname).append([['d', b'text of d']])
+        yield
+
+    dead = seg.compact(locked)
+    expected = {'a': b'new a', 'b': b'text of b', 'd': b'text of d'}
+    assert dead > 0
+    assert seg.token != token
+    assert seg.dead == 0
+    assert contents(seg) == expected
+    assert contents(segment(segname)) == expected
+    assert os.path.getsize(segname) < size
+    assert os.listdir(os.path.dirname(segname)) == [os.path.basename(segname)]
+    # a reader that mapped the old file still reads it, and sees the new file on refresh
+    assert contents(reader) == {'a': b'new a', 'b': b'text of b'}
+    assert contents(reader.refresh()) == expected
+
+
+def test_compact_of_a_missing_segment(segname):
+    assert nsd['nsd_leafsegment'](segname).compact(contextlib.nullcontext) == 0
+    assert not os.path.exists(segname)
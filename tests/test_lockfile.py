@@ -0,0 +1,113 @@
+'''Tests of NSD_LOCKFILE across processes.
+
+Database file1.py is executed into a namespace of its own, as the rest of NSD does.'''
+import multiprocessing
+import os
+import tempfile
+
+import pytest
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+nsd = {'__name__': 'nsd_test'}
+with open(os.path.join(here, 'Database file1.py')) as fid:
+    exec(compile(fid.read(), 'Database file1.py', 'exec'), nsd)
+
+fork = multiprocessing.get_context('fork')
+
+
+def deadpid():
+    '''DEADPID - the process id of a process that has exited'''
+    p = fork.Process(target=int)
+    p.start()
+    p.join()
+    return p.pid
+
+
+def holdlock(filename, exclusive, held, release):
+    lock = nsd['nsd_lockfile'](filename)
+    assert lock.acquire(exclusive, 5)
+    held.set()
+    release.wait(10)
+    lock.release()
+
+
+@pytest.fixture
+def lockname():
+    with tempfile.TemporaryDirectory() as d:
+        yield os.path.join(d, 'object-lock')
+
+
+def holder(lockname, exclusive):
+    '''HOLDER - start a process that holds the lock until the returned event is set'''
+    held, release = fork.Event(), fork.Event()
+    p = fork.Process(target=holdlock, args=(lockname, exclusive, held, release))
+    p.start()
+    assert held.wait(10)
+    return p, release
+
+
+def test_shared_holder_with_dead_pid_in_file_keeps_writers_out(lockname):
+    p, release = holder(lockname, 0)
+    try:
+        # an exclusive holder that crashed left its process id behind
+        with open(lockname, 'w') as fid:
+            fid.write('%d %s\n' % (deadpid(), nsd['socket'].gethostname()))
+        assert nsd['nsd_lockfile'](lockname).acquire(1, 0.2) == 0
+    finally:
+        release.set()
+        p.join()
+    lock = nsd['nsd_lockfile'](lockname)
+    assert lock.acquire(1, 5) == 1
+    lock.release()
+
+
+def test_exclusive_holder_keeps_other_processes_out(lockname):
+    p, release = holder(lockname, 1)
+    try:
+        assert nsd['nsd_lockfile'](lockname).acquire(1, 0.2) == 0
+        assert nsd['nsd_lockfile'](lockname).acquire(0, 0.2) == 0
+        assert nsd['nsd_lockfile'](lockname).describe().endswith('process %d on %s.' % (p.pid, nsd['socket'].gethostname()))
+    finally:
+        release.set()
+        p.join()
+
+
+def test_lock_file_left_by_crashed_process_is_reused(lockname):
+    with open(lockname, 'w') as fid:
+        fid.write('%d %s\n' % (deadpid(), nsd['socket'].gethostname()))
+    lock = nsd['nsd_lockfile'](lockname)
+    assert lock.acquire(1, 1) == 1
+    assert lock.holder() == [os.getpid(), nsd['socket'].gethostname()]
+    lock.release()
+    assert not os.path.exists(lockname)
+
+
+def test_release_does_not_remove_newer_lock_file(lockname):
+    lock = nsd['nsd_lockfile'](lockname)
+    assert lock.acquire(1, 1)
+    # the file was replaced behind our back, and another process holds the new one
+    os.remove(lockname)
+    p, release = holder(lockname, 1)
+    try:
+        lock.release()
+        assert os.path.exists(lockname)
+        assert nsd['nsd_lockfile'](lockname).acquire(1, 0.2) == 0
+    finally:
+        release.set()
+        p.join()
+
+
+def test_writeobjectfile_does_not_write_while_another_process_holds_the_lock(tmp_path, monkeypatch):
+    monkeypatch.setitem(nsd, 'nsd_locktimeout', 0.3)
+    obj = nsd['nsd_base']()
+    filename = os.path.join(str(tmp_path), obj._objectfilename_)
+    p, release = holder(obj.lockfilename(str(tmp_path)), 1)
+    try:
+        with pytest.raises(Exception, match='Could not obtain the lock'):
+            obj.writeobjectfile(str(tmp_path))
+        assert not os.path.exists(filename)
+    finally:
+        release.set()
+        p.join()
+    obj.writeobjectfile(str(tmp_path))
+    assert os.path.exists(filename)